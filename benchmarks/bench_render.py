@@ -0,0 +1,207 @@
+"""Benchmark offline cho pipeline render của resources/editor.py.
+
+Không cần mạng: video nguồn được tạo bằng lavfi (testsrc2 + sine), fetch_video_metadata /
+download_main_video / download_thumbnail được thay bằng bản copy file cục bộ. Mỗi trường hợp
+(độ phân giải x thời lượng x layout x số phần x encoder) chạy trong một tiến trình Python riêng
+để đo được peak RSS của các tiến trình ffmpeg con. Kết quả ghi ra JSON để so sánh giữa các commit.
+
+    python benchmarks/bench_render.py --resolutions 1280x720,1920x1080 --durations 60 \
+        --parts 1,4 --encoders libx264 --output bench.json
+"""
+import sys, os, json, argparse, subprocess, shutil, time, glob, platform, tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCES_PATH = os.path.join(REPO_ROOT, "resources")
+sys.path.insert(0, RESOURCES_PATH)
+
+import editor
+
+LAYOUTS = ['video', 'video_images', 'video_images_text']
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+]
+
+def find_tool(name, explicit):
+    if explicit:
+        return explicit
+    bundled = editor.get_executable_path(name, RESOURCES_PATH)
+    return bundled if os.path.exists(bundled) else (shutil.which(name) or name)
+
+def find_font(explicit):
+    for candidate in ([explicit] if explicit else []) + FONT_CANDIDATES:
+        if candidate and os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError("Không tìm thấy font .ttf, truyền vào bằng --font.")
+
+def run_quiet(cmd):
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_source(ffmpeg_path, sources_dir, resolution, duration):
+    # Nguồn tổng hợp có GOP 2 giây giống video tải về, được tạo một lần và dùng lại giữa các lần chạy
+    path = os.path.join(sources_dir, f"src_{resolution}_{duration}s.mp4")
+    if not os.path.exists(path):
+        run_quiet([ffmpeg_path, '-y', '-f', 'lavfi', '-i', f"testsrc2=size={resolution}:rate=30:duration={duration}",
+                   '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=44100:duration={duration}",
+                   '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60', '-pix_fmt', 'yuv420p',
+                   '-c:a', 'aac', '-shortest', path])
+    return path
+
+def make_image(ffmpeg_path, sources_dir, name, lavfi_source):
+    path = os.path.join(sources_dir, name)
+    if not os.path.exists(path):
+        run_quiet([ffmpeg_path, '-y', '-f', 'lavfi', '-i', lavfi_source, '-frames:v', '1', path])
+    return path
+
+def build_layout(kind, image_paths):
+    # Bố cục đại diện: video giữa khung, thumbnail phía trên, N ảnh trang trí, chữ "Part N" phía dưới
+    layout = [{'id': 'video-placeholder', 'type': 'video', 'x': 0, 'y': 320, 'width': 720, 'height': 405, 'zIndex': 1}]
+    if kind in ('video_images', 'video_images_text'):
+        layout.append({'id': 'thumbnail-placeholder', 'type': 'thumbnail', 'x': 0, 'y': 0, 'width': 720, 'height': 320, 'zIndex': 0})
+        for i, image_path in enumerate(image_paths):
+            layout.append({'id': f"image-{i}", 'type': 'image', 'source': image_path,
+                           'x': 40 + (i % 4) * 160, 'y': 760 + (i // 4) * 160, 'width': 140, 'height': 140, 'zIndex': 2 + i})
+    if kind == 'video_images_text':
+        layout.append({'id': 'text-placeholder', 'type': 'text', 'x': 60, 'y': 1100, 'width': 600, 'height': 120,
+                       'zIndex': 100, 'textStyle': {'fontSize': 70, 'fontColor': '#FFFFFF', 'outlineWidth': 2}})
+    return layout
+
+def run_case(case):
+    # Chạy trong tiến trình con: RUSAGE_CHILDREN chỉ chứa các ffmpeg của trường hợp này
+    work_dir = case['work_dir']
+    shutil.rmtree(work_dir, ignore_errors=True)
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir)
+
+    video_info = {'id': f"bench_{case['resolution']}_{case['duration']}", 'title': 'bench', 'thumbnail': case['thumbnail'],
+                  'duration': case['duration'], 'formats': []}
+    editor.fetch_video_metadata = lambda url, yt_dlp_path, cookies_path: video_info
+    editor.download_main_video = lambda url, yt_dlp_path, ffmpeg_path, dest_path, *args, **kwargs: shutil.copyfile(case['source'], dest_path)
+    editor.download_thumbnail = lambda thumbnail_url, dest_path: shutil.copyfile(thumbnail_url, dest_path)
+
+    runtime = {
+        'yt_dlp_path': 'yt-dlp', 'ffmpeg_path': case['ffmpeg'], 'ffprobe_path': case['ffprobe'], 'font_path': case['font'],
+        'cookies_path': os.path.join(work_dir, 'cookies.txt'), 'output_dir': output_dir, 'temp_root': os.path.join(work_dir, "temp"),
+        'logs_dir': os.path.join(work_dir, "logs"), 'metadata_dir': os.path.join(work_dir, "metadata"),
+        'metadata_ttl_seconds': 0, 'metadata_backend': 'process', 'media_dir': None, 'max_cache_bytes': None, 'downloader_args': [],
+    }
+    options = editor.build_options(case['parts'], 0, case['encoder'], case['seek_mode'], case['render_mode'], case['jobs'])
+    templates = [('bench', case['layout'])]
+    temp_dir = runtime['temp_root']
+    os.makedirs(temp_dir)
+
+    with editor.job_log(runtime['logs_dir'], "bench"), open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            with editor.contextlib.ExitStack() as cache_leases:
+                source = editor.prepare_source('bench://source', templates, options, runtime, temp_dir, cache_leases)
+                started = time.perf_counter()
+                editor.render_source(source, templates, options, runtime, temp_dir)
+                wall_time = time.perf_counter() - started
+        finally:
+            sys.stdout = stdout
+
+    outputs = glob.glob(os.path.join(output_dir, "*_Part_*.mp4"))
+    rendered_seconds = source['num_parts'] * source['part_duration']
+    result = {
+        'wall_time': round(wall_time, 3),
+        'realtime_factor': round(rendered_seconds / wall_time, 3) if wall_time > 0 else None,
+        'peak_rss_mb': peak_child_rss_mb(),
+        'output_bytes': sum(os.path.getsize(path) for path in outputs),
+        'outputs': len(outputs),
+    }
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+def peak_child_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux báo KiB, macOS báo byte
+    return round(max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024, 1)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline render benchmark")
+    parser.add_argument('--ffmpeg', default="")
+    parser.add_argument('--ffprobe', default="")
+    parser.add_argument('--font', default="")
+    parser.add_argument('--resolutions', default="1280x720,1920x1080")
+    parser.add_argument('--durations', default="60")
+    parser.add_argument('--layouts', default=",".join(LAYOUTS))
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument('--parts', default="1,4")
+    parser.add_argument('--encoders', default="libx264")
+    parser.add_argument('--seek-mode', choices=['input', 'filter'], default='input')
+    parser.add_argument('--render-mode', choices=['per-part', 'single-pass'], default='per-part')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), "rendertool-bench"))
+    parser.add_argument('--output', default="")
+    parser.add_argument('--run-case', default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        with open(args.run_case, 'r', encoding='utf-8') as f:
+            print(json.dumps(run_case(json.load(f))))
+        return
+
+    ffmpeg_path, ffprobe_path, font_path = find_tool("ffmpeg", args.ffmpeg), find_tool("ffprobe", args.ffprobe), find_font(args.font)
+    sources_dir = os.path.join(args.work_dir, "sources")
+    os.makedirs(sources_dir, exist_ok=True)
+    thumbnail = make_image(ffmpeg_path, sources_dir, "thumbnail.jpg", "testsrc2=size=1280x720")
+    image_paths = [make_image(ffmpeg_path, sources_dir, f"image_{i}.png", f"color=c=0x{(i * 0x3F6A21) % 0xFFFFFF:06x}:size=256x256")
+                   for i in range(args.images)]
+
+    results = []
+    for resolution in args.resolutions.split(','):
+        for duration in [int(d) for d in args.durations.split(',')]:
+            source = make_source(ffmpeg_path, sources_dir, resolution, duration)
+            for layout_kind in args.layouts.split(','):
+                for parts in [int(p) for p in args.parts.split(',')]:
+                    for encoder in args.encoders.split(','):
+                        case = {
+                            'resolution': resolution, 'duration': duration, 'layout_kind': layout_kind, 'parts': parts,
+                            'encoder': encoder, 'seek_mode': args.seek_mode, 'render_mode': args.render_mode, 'jobs': args.jobs,
+                            'layout': build_layout(layout_kind, image_paths), 'source': source, 'thumbnail': thumbnail,
+                            'ffmpeg': ffmpeg_path, 'ffprobe': ffprobe_path, 'font': font_path,
+                            'work_dir': os.path.join(args.work_dir, "case"),
+                        }
+                        case_path = os.path.join(args.work_dir, "case.json")
+                        with open(case_path, 'w', encoding='utf-8') as f:
+                            json.dump(case, f)
+                        for run in range(args.repeat):
+                            process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', case_path],
+                                                     capture_output=True, text=True, encoding='utf-8')
+                            entry = {key: case[key] for key in ('resolution', 'duration', 'layout_kind', 'parts', 'encoder',
+                                                                 'seek_mode', 'render_mode', 'jobs')}
+                            entry['run'] = run + 1
+                            if process.returncode == 0:
+                                entry.update(json.loads(process.stdout.strip().splitlines()[-1]))
+                            else:
+                                entry['error'] = (process.stderr.strip().splitlines() or [f"exit {process.returncode}"])[-1]
+                            results.append(entry)
+                            print(json.dumps(entry, ensure_ascii=False), file=sys.stderr)
+
+    report = {
+        'revision': git_revision(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(),
+        'cpu_count': os.cpu_count(), 'ffmpeg': ffmpeg_path, 'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
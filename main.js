@@ -1,15 +1,20 @@
-const { app, BrowserWindow, ipcMain, dialog, Menu } = require('electron');
+const { app, BrowserWindow, ipcMain, dialog, Menu, protocol, net } = require('electron');
 const path = require('path');
 const { spawn } = require('child_process');
+const { pathToFileURL } = require('url');
 const Store = require('electron-store');
 const fontList = require('font-list');
 const fs = require('fs');
-const os = require('os');
 const { autoUpdater } = require('electron-updater');
 
 const store = new Store();
 let mainWindow;
 
+// Ảnh trong layout được lưu dạng file:// URL; trang (kể cả http://localhost khi dev) hiển thị qua rt-asset://
+protocol.registerSchemesAsPrivileged([
+  { scheme: 'rt-asset', privileges: { standard: true, secure: true, supportFetchAPI: true } },
+]);
+
 function createWindow() {
   mainWindow = new BrowserWindow({
     width: 1600,
@@ -28,6 +33,11 @@ function createWindow() {
 }
 
 app.whenReady().then(() => {
+  protocol.handle('rt-asset', request => {
+    const fileUrl = new URL(request.url).searchParams.get('src') || '';
+    if (!isAllowedImageUrl(fileUrl)) return new Response('', { status: 403 });
+    return net.fetch(fileUrl);
+  });
   createWindow();
   if (!app.isPackaged) {
     console.log('Update check skipped in development mode.');
@@ -39,6 +49,18 @@ app.whenReady().then(() => {
 app.on('window-all-closed', () => { if (process.platform !== 'darwin') app.quit(); });
 app.on('activate', () => { if (BrowserWindow.getAllWindows().length === 0) createWindow(); });
 
+// rt-asset:// chỉ trả về ảnh người dùng đã chọn qua hộp thoại hoặc ảnh nằm trong template đã lưu,
+// để script trong trang không đọc được file khác trên máy (ví dụ cookies.txt)
+const IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'webp', 'gif'];
+const pickedImageUrls = new Set();
+function isAllowedImageUrl(fileUrl) {
+  if (!fileUrl.startsWith('file://')) return false;
+  const extension = path.extname(new URL(fileUrl).pathname).slice(1).toLowerCase();
+  if (!IMAGE_EXTENSIONS.includes(extension)) return false;
+  if (pickedImageUrls.has(fileUrl)) return true;
+  return store.get('templates', []).some(template => (template.layout || []).some(item => item.source === fileUrl));
+}
+
 // Các hàm xử lý IPC không thay đổi
 ipcMain.handle('templates:get', () => store.get('templates', []));
 ipcMain.handle('templates:save', (event, template) => {
@@ -74,16 +96,13 @@ ipcMain.on('show-context-menu', (event, { elementId, elementType }) => {
 ipcMain.handle('dialog:openImage', async () => {
   const { canceled, filePaths } = await dialog.showOpenDialog(mainWindow, {
     properties: ['openFile'],
-    filters: [{ name: 'Images', extensions: ['png', 'jpg', 'jpeg', 'webp', 'gif'] }],
+    filters: [{ name: 'Images', extensions: IMAGE_EXTENSIONS }],
   });
   if (canceled || !filePaths || filePaths.length === 0) { return null; }
-  try {
-    const filePath = filePaths[0];
-    const fileData = fs.readFileSync(filePath);
-    const base64Data = fileData.toString('base64');
-    const mimeType = `image/${path.extname(filePath).substring(1)}`;
-    return `data:${mimeType};base64,${base64Data}`;
-  } catch (error) { return null; }
+  // Trả về file:// URL thay vì nhúng base64 vào layout, editor.py đọc thẳng file ảnh
+  const fileUrl = pathToFileURL(filePaths[0]).href;
+  pickedImageUrls.add(fileUrl);
+  return fileUrl;
 });
 ipcMain.handle('dialog:openDirectory', async () => {
   const { canceled, filePaths } = await dialog.showOpenDialog(mainWindow, { properties: ['openDirectory'] });
@@ -107,54 +126,162 @@ ipcMain.handle('cookies:update', async () => {
   }
 });
 
-ipcMain.on('video:runProcessWithLayout', (event, { url, parts, partDuration, savePath, layout, encoder }) => {
+// Một tiến trình editor.py --server sống suốt phiên làm việc, mỗi job là một request JSON-lines
+let renderWorker = null;
+let nextRequestId = 1;
+const workerJobs = new Map();
+// Request chờ response (preview): id -> { resolve, reject }
+const pendingRequests = new Map();
+
+function getRenderWorker() {
+  if (renderWorker) return renderWorker;
   const resourcesPath = app.isPackaged ? process.resourcesPath : path.join(__dirname, 'resources');
-  const pythonScriptPath = path.join(resourcesPath, 'editor.py');
-  const userDataPath = app.getPath('userData');
-  const layoutFilePath = path.join(os.tmpdir(), `layout-${Date.now()}.json`);
-  fs.writeFileSync(layoutFilePath, JSON.stringify(layout));
-
-  const pythonProcess = spawn('python', [
-    pythonScriptPath, '--resources-path', resourcesPath, '--user-data-path', userDataPath,
-    '--url', url, '--parts', String(parts), '--save-path', savePath,
-    '--part-duration', String(partDuration), '--layout-file', layoutFilePath, '--encoder', encoder
+  const worker = spawn('python', [
+    path.join(resourcesPath, 'editor.py'), '--server',
+    '--resources-path', resourcesPath, '--user-data-path', app.getPath('userData'),
   ], { env: { ...process.env, PYTHONIOENCODING: 'utf-8' } });
-  
-  // Xử lý output theo từng dòng để không bỏ sót
-  pythonProcess.stdout.on('data', data => {
-    const lines = data.toString('utf8').split(/(\r\n|\n|\r)/);
+
+  let buffered = '';
+  worker.stdout.on('data', data => {
+    buffered += data.toString('utf8');
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
     for (const line of lines) {
-      const logLine = line.trim();
-      if (!logLine) continue; // Bỏ qua các dòng trống
-
-      if (logLine.startsWith('PROGRESS:')) {
-        const parts = logLine.split(':');
-        const type = parts[1];
-        const value = parseFloat(parts[2]);
-        mainWindow.webContents.send('process:progress', { type, value });
-      } else {
-        mainWindow.webContents.send('process:log', logLine);
+      if (!line.trim()) continue;
+      try {
+        handleWorkerEvent(JSON.parse(line));
+      } catch (err) {
+        mainWindow.webContents.send('process:log', line.trim());
       }
     }
   });
-  
-  pythonProcess.stderr.on('data', data => {
+  worker.stderr.on('data', data => {
     const logLine = data.toString('utf8').trim();
     if (logLine) {
         mainWindow.webContents.send('process:log', `PYTHON_ERROR: ${logLine}`);
     }
   });
-  pythonProcess.on('error', err => {
+  worker.on('error', err => {
     mainWindow.webContents.send('process:log', `FATAL_ERROR: Không thể khởi chạy Python. ${err.message}`);
   });
-  pythonProcess.on('close', code => {
-    if (code === 403) {
-      mainWindow.webContents.send('process:cookie-required');
+  worker.on('close', code => {
+    renderWorker = null;
+    for (const { reject } of pendingRequests.values()) {
+      reject(new Error(`Tiến trình xử lý kết thúc với mã ${code}`));
     }
-    mainWindow.webContents.send('process:log', `--- Tiến trình kết thúc với mã ${code} ---`);
-    mainWindow.webContents.send('process:progress', { type: 'DONE', value: 100 });
-    if (fs.existsSync(layoutFilePath)) {
-      fs.unlinkSync(layoutFilePath);
+    pendingRequests.clear();
+    if (workerJobs.size > 0) {
+      mainWindow.webContents.send('process:log', `--- Tiến trình kết thúc với mã ${code} ---`);
+      mainWindow.webContents.send('process:progress', { type: 'DONE', value: 100 });
+      workerJobs.clear();
     }
   });
+  renderWorker = worker;
+  return worker;
+}
+
+function sendWorkerRequest(method, params) {
+  const id = nextRequestId++;
+  getRenderWorker().stdin.write(JSON.stringify({ id, method, params }) + '\n');
+  return id;
+}
+
+function callWorker(method, params) {
+  return new Promise((resolve, reject) => {
+    const id = sendWorkerRequest(method, params);
+    pendingRequests.set(id, { resolve, reject });
+  });
+}
+
+function handleWorkerEvent(msg) {
+  if (msg.id !== undefined && pendingRequests.has(msg.id)) {
+    const { resolve, reject } = pendingRequests.get(msg.id);
+    pendingRequests.delete(msg.id);
+    if (msg.error) reject(new Error(msg.error)); else resolve(msg.result);
+    return;
+  }
+  if (msg.error && msg.id !== undefined) {
+    mainWindow.webContents.send('process:log', `PYTHON_ERROR: ${msg.error}`);
+    return;
+  }
+  if (!msg.event || !workerJobs.has(msg.job)) return;
+  // Job batch gắn số thứ tự video vào từng sự kiện
+  const itemPrefix = msg.item ? `[Video ${msg.item}] ` : '';
+  switch (msg.event) {
+    case 'progress':
+      if (msg.type === 'render_progress') {
+        // Sự kiện từ ffmpeg -progress: phần trăm của cả job kèm tốc độ và thời gian còn lại
+        const percent = msg.job_percent ?? msg.percent ?? 0;
+        mainWindow.webContents.send('process:progress', {
+          type: 'RENDER', value: Math.round(percent), part: msg.part, fps: msg.fps,
+          speed: msg.speed, eta: msg.job_eta ?? msg.eta,
+        });
+      } else {
+        mainWindow.webContents.send('process:progress', { type: msg.type, value: msg.value });
+      }
+      break;
+    case 'status':
+      mainWindow.webContents.send('process:log', `${itemPrefix}STATUS: ${msg.message}`);
+      break;
+    case 'result':
+      mainWindow.webContents.send('process:log', `RESULT:${msg.message}`);
+      break;
+    case 'error':
+      // Lỗi của một video trong batch không dừng cả lần chạy; lỗi của job được báo ở cuối
+      mainWindow.webContents.send('process:log', msg.item ? `${itemPrefix}Lỗi: ${msg.message}` : `PYTHON_ERROR: ${msg.message}`);
+      break;
+    case 'log':
+      mainWindow.webContents.send('process:log', itemPrefix + msg.message);
+      break;
+    case 'done':
+      workerJobs.delete(msg.job);
+      if (!msg.ok && msg.log) {
+        mainWindow.webContents.send('process:log', `Chi tiết lỗi được lưu tại: ${msg.log}`);
+      }
+      mainWindow.webContents.send('process:log', msg.cancelled ? `--- Job ${msg.job} đã bị hủy ---` : `--- Job ${msg.job} xong ---`);
+      // Renderer chỉ coi lần chạy là xong khi job cuối cùng kết thúc (dòng "--- Tiến trình kết thúc" như khi còn spawn từng job)
+      if (workerJobs.size === 0) {
+        mainWindow.webContents.send('process:log', '--- Tiến trình kết thúc ---');
+        mainWindow.webContents.send('process:progress', { type: 'DONE', value: 100 });
+      }
+      break;
+  }
+}
+
+ipcMain.on('video:runProcessWithLayout', (event, { url, urls, parts, partDuration, savePath, layout, layouts, encoder, jobs, streaming }) => {
+  // Nhiều template ({ name, layout }) được gửi dưới dạng manifest để editor.py render chung một lần giải mã
+  const layoutData = Array.isArray(layouts) && layouts.length > 0 ? { templates: layouts } : layout;
+  const jobId = `job-${Date.now()}`;
+  const params = {
+    job: jobId, parts, part_duration: partDuration, save_path: savePath,
+    layouts: [layoutData], encoder, jobs: jobs || 1, streaming: Boolean(streaming),
+  };
+  workerJobs.set(jobId, {});
+  if (Array.isArray(urls) && urls.length > 1) {
+    // Nhiều URL: một job batch, worker tải video sau trong lúc render video trước
+    sendWorkerRequest('batch', { ...params, urls });
+  } else {
+    sendWorkerRequest('render', { ...params, url: Array.isArray(urls) && urls.length === 1 ? urls[0] : url });
+  }
+  event.sender.send('process:job-started', jobId);
+});
+
+// Preview nhanh một khung hình của layout tại thời điểm `time` (giây), trả về data URL của ảnh
+ipcMain.handle('video:preview', async (event, { url, layout, time, part }) => {
+  try {
+    const result = await callWorker('preview', { url, layout, time: time || 0, part: part || 1 });
+    return { success: true, dataUrl: result.data_url, path: result.path };
+  } catch (error) {
+    return { success: false, message: error.message };
+  }
+});
+
+ipcMain.on('video:cancelJob', (event, jobId) => {
+  if (renderWorker && workerJobs.has(jobId)) {
+    sendWorkerRequest('cancel', { job: jobId });
+  }
+});
+
+app.on('will-quit', () => {
+  if (renderWorker) renderWorker.stdin.end();
 });
@@ -7,6 +7,13 @@ contextBridge.exposeInMainWorld('electronAPI', {
   saveTemplate: (template) => ipcRenderer.invoke('templates:save', template),
   deleteTemplate: (templateId) => ipcRenderer.invoke('templates:delete', templateId),
   runProcessWithLayout: (args) => ipcRenderer.send('video:runProcessWithLayout', args),
+  cancelJob: (jobId) => ipcRenderer.send('video:cancelJob', jobId),
+  renderPreview: (args) => ipcRenderer.invoke('video:preview', args),
+  onJobStarted: (callback) => {
+    const listener = (_event, value) => callback(value);
+    ipcRenderer.on('process:job-started', listener);
+    return () => ipcRenderer.removeListener('process:job-started', listener);
+  },
   onProcessLog: (callback) => {
     const listener = (_event, value) => callback(value);
     ipcRenderer.on('process:log', listener);
@@ -11,6 +11,11 @@ const initialElements = [
   { id: 'text-placeholder', type: 'text', zIndex: 3 },
 ];
 
+// Ảnh chọn từ máy được lưu dạng file:// URL; Chromium chặn file:// trên trang http://localhost nên hiển thị qua rt-asset://
+function toDisplayUrl(source) {
+  return source.startsWith('file://') ? `rt-asset://local/?src=${encodeURIComponent(source)}` : source;
+}
+
 function LogModal({ log, onClose }) {
   return (
     <div className="log-modal-overlay" onClick={onClose}>
@@ -79,11 +84,12 @@ function App() {
     });
 
     // Lắng nghe trên kênh tiến trình mới
-    const removeProgressListener = window.electronAPI.onProcessProgress(({ type, value }) => {
+    const removeProgressListener = window.electronAPI.onProcessProgress(({ type, value, speed, eta }) => {
       if (type === 'DOWNLOAD') {
         setStatusText(`Đang tải video... ${value}%`);
       } else if (type === 'RENDER') {
-        setStatusText(`Đang render... ${value}%`);
+        const details = speed && eta != null ? ` (${speed}x, còn ~${Math.ceil(eta)}s)` : '';
+        setStatusText(`Đang render... ${value}%${details}`);
       }
     });
 
@@ -246,7 +252,7 @@ function App() {
             textShadow: `${textStyle.outlineColor} 0px 0px ${textStyle.outlineWidth}px, ${textStyle.shadowColor} ${textStyle.shadowDepth}px ${textStyle.shadowDepth}px 2px`
         };
       } else if (type === 'image' && source) {
-        specificStyle.backgroundImage = `url('${source}')`;
+        specificStyle.backgroundImage = `url('${toDisplayUrl(source)}')`;
       }
       return (
         <div 
@@ -1,4 +1,53 @@
-import sys, os, subprocess, json, re, argparse, urllib.request, shutil, base64
+import sys, os, subprocess, json, re, argparse, urllib.request, urllib.parse, shutil, base64, threading, time, hashlib, glob, contextlib, math, bisect
+import contextvars, queue, collections, logging, logging.handlers
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+_output_lock = threading.Lock()
+_active_processes = set()
+# Nhãn ITEM của video đang xử lý (chế độ batch) và các nhóm tiến trình con của công việc hiện tại.
+# Một tiến trình được ghi vào mọi nhóm trong chuỗi để hủy job cũng dừng được các worker render của nó.
+_emit_tag = contextvars.ContextVar('emit_tag', default=None)
+_process_group = contextvars.ContextVar('process_group', default=(_active_processes,))
+# Chế độ server: nơi nhận các dòng emit của job và cờ hủy job
+_emit_sink = contextvars.ContextVar('emit_sink', default=None)
+_cancel_event = contextvars.ContextVar('cancel_event', default=None)
+# Tiến độ render của job hiện tại, dùng để tính ETA chung khi nhiều phần chạy song song
+_render_progress = contextvars.ContextVar('render_progress', default=None)
+# Nhật ký của job hiện tại (logging.Logger ghi ra file xoay vòng)
+_job_log = contextvars.ContextVar('job_log', default=None)
+LOG_TAIL_LINES = 200
+JOB_LOG_MAX_BYTES = 5 * 1024 * 1024
+JOB_LOG_BACKUPS = 2
+MAX_JOB_LOGS = 50
+FFMPEG_PROGRESS_KEYS = {'frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms', 'out_time',
+                        'dup_frames', 'drop_frames', 'speed', 'progress'}
+# ffmpeg còn in chất lượng từng luồng dạng stream_<file>_<luồng>_q=
+FFMPEG_STREAM_PROGRESS_KEY = re.compile(r"stream_\d+_\d+_\w+")
+
+DEFAULT_VIDEO_FORMAT = "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+MAX_SOURCE_HEIGHT = 1080
+CACHE_LOCK_STALE_SECONDS = 6 * 3600
+CACHE_IN_USE_STALE_SECONDS = 24 * 3600
+SECTION_KEYFRAME_MARGIN_SECONDS = 10
+CANVAS_WIDTH, CANVAS_HEIGHT = 720, 1280
+FOREGROUND_LAYER_ID = 'foreground-layer'
+METADATA_LOCK_STALE_SECONDS = 300
+# Link tải trong metadata có hạn (tham số expire=), bỏ cache khi link sắp hết hạn
+METADATA_URL_MARGIN_SECONDS = 30 * 60
+# Chế độ streaming: chỉ render một phần khi đã có thêm ngần này giây sau điểm kết thúc của nó
+STREAM_MARGIN_SECONDS = 5
+# Preview: khung hình nguồn được lấy ở độ phân giải thấp và lưu theo từng video
+PREVIEW_PROXY_HEIGHT = 480
+MAX_PREVIEWS_PER_VIDEO = 20
+# Tổng dung lượng preview_cache (khung hình, lớp ảnh, preview); mục mới dùng trong PREVIEW_IN_USE_SECONDS không bị xóa
+MAX_PREVIEW_CACHE_BYTES = 512 * 1024 ** 2
+PREVIEW_IN_USE_SECONDS = 120
+YOUTUBE_ID_PATTERN = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})')
 
 def get_executable_path(name, resources_path):
     executable_name = name if sys.platform != 'win32' else f"{name}.exe"
@@ -24,31 +73,201 @@ def hex_to_ffmpeg_color(hex_color, alpha='ff'):
     except:
         return "0xFFFFFFFF"
 
-def run_command_with_live_output(cmd):
+def log_line(message):
+    logger = _job_log.get()
+    if logger is not None:
+        logger.info(message)
+
+def emit(message, end='\n', file=None):
+    # Nhiều worker render song song cùng ghi stdout, khóa lại để các dòng STATUS:/RESULT: không bị trộn lẫn
+    if message and end != '\r' and not message.startswith(('EVENT:', 'PROGRESS:')):
+        log_line(message)
+    tag = _emit_tag.get()
+    if tag is not None and message:
+        message = f"ITEM:{tag}:{message}"
+    sink = _emit_sink.get()
+    if sink is not None:
+        sink(message, end)
+        return
+    with _output_lock:
+        print(message, end=end, file=file or sys.stdout, flush=True)
+
+def terminate_active_processes(group=None):
+    with _output_lock:
+        processes = list(_active_processes if group is None else group)
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+
+def parse_download_percent(line):
+    # yt-dlp: "[download]  42.1% of ...", aria2c: "[#2089b0 12MiB/100MiB(12%) CN:16 DL:8.1MiB]"
+    if line.startswith('[download]') and '%' in line:
+        match = re.search(r"(\d+(?:\.\d+)?)%", line)
+    elif line.startswith('[#'):
+        match = re.search(r"\((\d+)%\)", line)
+    else:
+        return None
+    return int(float(match.group(1))) if match else None
+
+def emit_event(event):
+    # Sự kiện có cấu trúc: một dòng EVENT:<json>, chế độ server chuyển thẳng thành sự kiện JSON của job
+    emit("EVENT:" + json.dumps(event, ensure_ascii=False))
+
+class RenderProgress:
+    # Gộp tiến độ các tiến trình ffmpeg của một job. ETA của job tính theo tốc độ trung bình từ lúc bắt đầu,
+    # nên vẫn đúng khi nhiều phần render song song.
+    def __init__(self, total_seconds):
+        self.total_seconds = total_seconds
+        self.started = time.monotonic()
+        self.done = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, seconds):
+        with self.lock:
+            self.done[key] = seconds
+            done = min(sum(self.done.values()), self.total_seconds)
+        elapsed = time.monotonic() - self.started
+        eta = (self.total_seconds - done) * elapsed / done if done > 0 else None
+        return done, eta
+
+def parse_progress_value(value, suffix=''):
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def is_ffmpeg_progress_key(key):
+    return key in FFMPEG_PROGRESS_KEYS or FFMPEG_STREAM_PROGRESS_KEY.fullmatch(key) is not None
+
+def build_progress_event(block, part, duration):
+    # Một khối key=value của "ffmpeg -progress" thành sự kiện render_progress
+    out_time_us = parse_progress_value(block.get('out_time_us', ''))
+    out_time = max(0.0, out_time_us / 1e6) if out_time_us is not None else 0.0
+    speed = parse_progress_value(block.get('speed', ''), 'x')
+    event = {
+        'type': 'render_progress', 'part': part, 'out_time': round(out_time, 3), 'duration': duration,
+        'frame': parse_progress_value(block.get('frame', '')), 'fps': parse_progress_value(block.get('fps', '')),
+        'speed': speed, 'bitrate_kbps': parse_progress_value(block.get('bitrate', ''), 'kbits/s'),
+        'total_size': parse_progress_value(block.get('total_size', '')),
+        'percent': round(min(100.0, out_time * 100 / duration), 1) if duration else None,
+        'eta': round(max(0.0, duration - out_time) / speed, 1) if duration and speed else None,
+        'finished': block.get('progress') == 'end',
+    }
+    tracker = _render_progress.get()
+    if tracker is not None:
+        job_done, job_eta = tracker.update(part, min(out_time, duration) if duration else out_time)
+        event['job_percent'] = round(job_done * 100 / tracker.total_seconds, 1) if tracker.total_seconds else None
+        event['job_eta'] = round(job_eta, 1) if job_eta is not None else None
+    return event
+
+@contextlib.contextmanager
+def job_log(logs_dir, name):
+    # Log đầy đủ của một job nằm trên đĩa (xoay vòng theo dung lượng), bộ nhớ chỉ giữ phần đuôi để báo lỗi
+    os.makedirs(logs_dir, exist_ok=True)
+    log_path = os.path.join(logs_dir, f"{sanitize_filename(name)}.log")
+    handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=JOB_LOG_MAX_BYTES, backupCount=JOB_LOG_BACKUPS, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    # Logger không đăng ký vào logging.Logger.manager để server chạy lâu không giữ lại một logger cho mỗi job
+    logger = logging.Logger(f"editor.job.{name}", logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    token = _job_log.set(logger)
+    try:
+        yield log_path
+    finally:
+        _job_log.reset(token)
+        logger.removeHandler(handler)
+        handler.close()
+        prune_job_logs(logs_dir)
+
+def prune_job_logs(logs_dir):
+    # Chỉ giữ MAX_JOB_LOGS job gần nhất
+    # Hai job kết thúc cùng lúc có thể xóa log của nhau giữa chừng
+    logs = []
+    for log_path in glob.glob(os.path.join(logs_dir, "*.log")):
+        try:
+            logs.append((os.path.getmtime(log_path), log_path))
+        except OSError:
+            pass
+    logs = [log_path for _, log_path in sorted(logs, reverse=True)]
+    for old_log in logs[MAX_JOB_LOGS:]:
+        for path in [old_log] + glob.glob(glob.escape(old_log) + ".*"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def job_log_name(prefix):
+    return f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+
+def check_cancelled():
+    cancel_event = _cancel_event.get()
+    if cancel_event is not None and cancel_event.is_set():
+        raise Exception("Job đã bị hủy.")
+
+def run_command_with_live_output(cmd, label=None, progress=None):
+    # progress = {'part': ..., 'duration': ...}: chạy ffmpeg với -progress pipe:1 -nostats và phát sự kiện render_progress
+    check_cancelled()
+    if progress is not None:
+        cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace')
+    groups = _process_group.get()
+    with _output_lock:
+        for group in groups:
+            group.add(process)
+    prefix = f"[{label}] " if label else ""
     
-    output = []
-    for line in iter(process.stdout.readline, ''):
-        trimmed_line = line.strip()
-        
-        is_download_progress = trimmed_line.startswith('[download]') and '%' in trimmed_line
-        is_ffmpeg_progress = trimmed_line.startswith('frame=')
-        is_error = 'ERROR' in trimmed_line.upper()
-
-        if is_download_progress or is_ffmpeg_progress:
-            print(trimmed_line, end='\r', flush=True)
-        elif is_error:
-            print(trimmed_line, flush=True)
+    # Chỉ giữ LOG_TAIL_LINES dòng cuối trong bộ nhớ; dòng tiến trình (\r) không được lưu
+    output = collections.deque(maxlen=LOG_TAIL_LINES)
+    last_download_percent = None
+    progress_block = {}
+    try:
+        for line in iter(process.stdout.readline, ''):
+            trimmed_line = line.strip()
+
+            key, sep, value = trimmed_line.partition('=')
+            if progress is not None and sep and is_ffmpeg_progress_key(key):
+                progress_block[key] = value
+                if key == 'progress':
+                    event = build_progress_event(progress_block, progress['part'], progress['duration'])
+                    emit(f"{prefix}time={event['out_time']:.1f}s fps={event['fps']} speed={event['speed']}x", end='\r')
+                    emit_event(event)
+                    progress_block = {}
+                continue
             
-        output.append(trimmed_line)
-    
-    print("", flush=True)
-    
-    process.wait()
+            download_percent = parse_download_percent(trimmed_line)
+            is_ffmpeg_progress = trimmed_line.startswith('frame=')
+            is_error = 'ERROR' in trimmed_line.upper()
+
+            if download_percent is not None:
+                emit(f"{prefix}{trimmed_line}", end='\r')
+                if download_percent != last_download_percent:
+                    last_download_percent = download_percent
+                    emit(f"PROGRESS:DOWNLOAD:{download_percent}")
+            elif is_ffmpeg_progress:
+                emit(f"{prefix}{trimmed_line}", end='\r')
+            elif trimmed_line:
+                if is_error:
+                    emit(f"{prefix}{trimmed_line}")
+                else:
+                    log_line(f"{prefix}{trimmed_line}")
+                output.append(trimmed_line)
+        
+        emit("")
+        
+        process.wait()
+    finally:
+        with _output_lock:
+            for group in groups:
+                group.discard(process)
+    check_cancelled()
     if process.returncode != 0:
-        full_log = '\n'.join(output)
-        print(f"Full log on error:\n{full_log}", flush=True)
-        raise subprocess.CalledProcessError(process.returncode, cmd, output=full_log)
+        log_tail = '\n'.join(output)
+        emit(f"{prefix}Log on error (last {len(output)} lines):\n{log_tail}")
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=log_tail)
     
     return '\n'.join(output)
 
@@ -66,9 +285,114 @@ def fetch_video_metadata(url, yt_dlp_path, cookies_path):
     except json.JSONDecodeError:
         raise Exception(f"Lỗi parse JSON từ yt-dlp. Đầu ra:\n{process.stdout}")
 
+def extract_metadata_in_process(url, cookies_path):
+    # Dùng thư viện yt_dlp ngay trong tiến trình, không phải khởi động lại yt-dlp và các extractor
+    options = {'quiet': True, 'no_warnings': True, 'noplaylist': True, 'skip_download': True}
+    if os.path.exists(cookies_path):
+        options['cookiefile'] = cookies_path
+    with yt_dlp.YoutubeDL(options) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+def normalize_video_key(url):
+    # Cùng một video có nhiều dạng URL (watch?v=, youtu.be/, shorts/...), khóa cache theo id video
+    match = YOUTUBE_ID_PATTERN.search(url)
+    if match:
+        return f"youtube_{match.group(1)}"
+    parts = urllib.parse.urlsplit(url.strip())
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if not k.startswith('utm_'))
+    normalized = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), urllib.parse.urlencode(query), ''))
+    return f"url_{hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]}"
+
+def metadata_url_expiry(video_info):
+    expiries = []
+    for f in video_info.get('formats') or []:
+        values = urllib.parse.parse_qs(urllib.parse.urlsplit(f.get('url') or '').query).get('expire')
+        if values and values[0].isdigit():
+            expiries.append(int(values[0]))
+    return min(expiries) if expiries else None
+
+def load_cached_metadata(info_path, ttl_seconds):
+    try:
+        if time.time() - os.path.getmtime(info_path) > ttl_seconds:
+            return None
+        with open(info_path, 'r', encoding='utf-8') as f:
+            video_info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    expiry = metadata_url_expiry(video_info)
+    if expiry is not None and expiry - time.time() < METADATA_URL_MARGIN_SECONDS:
+        return None
+    return video_info
+
+def get_video_metadata(url, runtime, temp_dir):
+    # Metadata được lưu trên đĩa theo id video (có TTL) và trả kèm đường dẫn file info.json
+    # để bước tải dùng lại qua --load-info-json thay vì phân tích trang lần nữa.
+    ttl_seconds = runtime['metadata_ttl_seconds']
+    if ttl_seconds > 0:
+        os.makedirs(runtime['metadata_dir'], exist_ok=True)
+        info_path = os.path.join(runtime['metadata_dir'], f"{normalize_video_key(url)}.info.json")
+    else:
+        info_path = os.path.join(temp_dir, "video.info.json")
 
-def download_main_video(url, yt_dlp_path, ffmpeg_path, dest_path, cookies_path):
-    format_string = "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+    with file_lock(info_path + ".lock", stale_after=METADATA_LOCK_STALE_SECONDS):
+        if ttl_seconds > 0:
+            video_info = load_cached_metadata(info_path, ttl_seconds)
+            if video_info is not None:
+                emit("STATUS: Dùng thông tin video đã lưu.")
+                return video_info, info_path
+        # yt-dlp lấy metadata không nằm trong nhóm tiến trình của job nên không hủy được giữa chừng
+        check_cancelled()
+        video_info = None
+        if runtime['metadata_backend'] == 'module':
+            # Thư viện yt_dlp cài kèm Python có thể cũ hơn file yt-dlp đi cùng app: lỗi thì quay về tiến trình yt-dlp
+            try:
+                video_info = extract_metadata_in_process(url, runtime['cookies_path'])
+            except Exception as e:
+                log_line(f"[metadata] yt_dlp trong tiến trình lỗi, chuyển sang yt-dlp: {e}")
+                emit("STATUS: Không lấy được thông tin video bằng thư viện yt_dlp, thử lại bằng yt-dlp...")
+        if video_info is None:
+            video_info = fetch_video_metadata(url, runtime['yt_dlp_path'], runtime['cookies_path'])
+        partial_path = info_path + ".partial"
+        with open(partial_path, 'w', encoding='utf-8') as f:
+            json.dump(video_info, f, ensure_ascii=False)
+        os.replace(partial_path, info_path)
+    return video_info, info_path
+
+def select_video_format(layouts, video_info, headroom=1.0):
+    # Chọn bản nhỏ nhất vẫn phủ kín khung video-placeholder lớn nhất trong các layout (sau khi nhân headroom),
+    # thay vì luôn tải 1080p rồi thu nhỏ xuống.
+    video_items = [item for layout in layouts for item in layout if item['type'] == 'video']
+    formats = [f for f in video_info.get('formats') or [] if f.get('vcodec') not in (None, 'none') and f.get('width') and f.get('height')]
+    if not video_items or not formats:
+        return DEFAULT_VIDEO_FORMAT
+    mp4_formats = [f for f in formats if f.get('ext') == 'mp4'] or formats
+    needed_w = max(item['width'] for item in video_items) * headroom
+    needed_h = max(item['height'] for item in video_items) * headroom
+    heights = sorted({f['height'] for f in mp4_formats if f['height'] <= MAX_SOURCE_HEIGHT})
+    if not heights:
+        return DEFAULT_VIDEO_FORMAT
+    target_height = next((f['height'] for f in sorted(mp4_formats, key=lambda f: f['height'])
+                          if f['height'] in heights and f['width'] >= needed_w and f['height'] >= needed_h), heights[-1])
+    return (f"bestvideo[height<={target_height}][ext=mp4]+bestaudio[ext=m4a]"
+            f"/best[height<={target_height}][ext=mp4]/best[height<={target_height}]/best")
+
+def build_downloader_args(resources_path, downloader, connections, split_size):
+    if downloader == 'native':
+        return []
+    aria2c_path = get_executable_path("aria2c", resources_path)
+    if not os.path.exists(aria2c_path):
+        if downloader == 'aria2c':
+            emit("Warning: Không tìm thấy aria2c, dùng trình tải mặc định của yt-dlp.")
+        return []
+    # aria2c giới hạn tối đa 16 kết nối cho mỗi server
+    connections = max(1, min(16, connections))
+    return [
+        "--downloader", aria2c_path,
+        "--downloader-args", f"aria2c:-x {connections} -s {connections} -k {split_size} --file-allocation=none",
+    ]
+
+def download_main_video(url, yt_dlp_path, ffmpeg_path, dest_path, cookies_path, format_string=DEFAULT_VIDEO_FORMAT, downloader_args=(), section=None,
+                        info_path=None):
     cmd = [
         yt_dlp_path,
         "--ffmpeg-location", ffmpeg_path,
@@ -79,184 +403,1348 @@ def download_main_video(url, yt_dlp_path, ffmpeg_path, dest_path, cookies_path):
         # Fix 2 (Mới): Ra lệnh trực tiếp cho yt-dlp cũng không nhúng metadata
         "--no-embed-metadata",
         "-o", dest_path,
-        url
+        *downloader_args,
+        *(["--load-info-json", info_path] if info_path else [url])
     ]
+    if section:
+        cmd += ["--download-sections", f"*{section[0]}-{section[1]}"]
     if os.path.exists(cookies_path):
         cmd += ["--cookies", cookies_path]
     
     run_command_with_live_output(cmd)
 
+class StreamingDownload:
+    # yt-dlp ghi video ra stdout, ffmpeg remux (không encode) sang MPEG-TS vào file tạm. File TS đọc được ngay
+    # khi đang lớn dần, nên các phần đầu có thể render trong lúc phần sau vẫn đang tải.
+    def __init__(self, url, runtime, format_string, info_path, dest_path, total_duration):
+        self.dest_path = dest_path
+        self.total_duration = total_duration
+        self.available = 0.0
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.log_tail = collections.deque(maxlen=LOG_TAIL_LINES)
+
+        download_cmd = [runtime['yt_dlp_path'], "--ffmpeg-location", runtime['ffmpeg_path'], "-f", format_string,
+                        "--no-part", "--quiet", "--no-warnings", "-o", "-"]
+        download_cmd += ["--load-info-json", info_path] if info_path else [url]
+        if os.path.exists(runtime['cookies_path']):
+            download_cmd += ["--cookies", runtime['cookies_path']]
+        remux_cmd = [runtime['ffmpeg_path'], '-y', '-progress', 'pipe:1', '-nostats', '-loglevel', 'error', '-i', 'pipe:0',
+                     '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-f', 'mpegts', dest_path]
+
+        check_cancelled()
+        self.downloader = subprocess.Popen(download_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.remuxer = subprocess.Popen(remux_cmd, stdin=self.downloader.stdout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, encoding='utf-8', errors='replace')
+        # Chỉ ffmpeg giữ đầu đọc của pipe, để yt-dlp nhận được lỗi khi ffmpeg dừng
+        self.downloader.stdout.close()
+        self.groups = _process_group.get()
+        with _output_lock:
+            for group in self.groups:
+                group.update((self.downloader, self.remuxer))
+        self.threads = [threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True)
+                        for target in (self.watch_remuxer, self.drain_downloader)]
+        for thread in self.threads:
+            thread.start()
+
+    def drain_downloader(self):
+        for line in iter(self.downloader.stderr.readline, b''):
+            trimmed_line = line.decode('utf-8', errors='replace').strip()
+            if trimmed_line:
+                log_line(f"[stream] {trimmed_line}")
+                self.log_tail.append(trimmed_line)
+
+    def watch_remuxer(self):
+        last_percent = None
+        for line in iter(self.remuxer.stdout.readline, ''):
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us':
+                seconds = parse_progress_value(value)
+                if seconds is None:
+                    continue
+                with self.condition:
+                    self.available = max(self.available, seconds / 1e6)
+                    self.condition.notify_all()
+                percent = min(100, int(self.available * 100 / self.total_duration)) if self.total_duration else None
+                if percent is not None and percent != last_percent:
+                    last_percent = percent
+                    emit(f"PROGRESS:DOWNLOAD:{percent}")
+            elif not is_ffmpeg_progress_key(key) and line.strip():
+                log_line(f"[stream] {line.strip()}")
+                self.log_tail.append(line.strip())
+        self.remuxer.wait()
+        self.downloader.wait()
+        with _output_lock:
+            for group in self.groups:
+                group.discard(self.downloader)
+                group.discard(self.remuxer)
+        with self.condition:
+            if self.remuxer.returncode != 0 or self.downloader.returncode != 0:
+                log_tail = '\n'.join(self.log_tail)
+                self.error = Exception(f"Tải streaming lỗi (yt-dlp {self.downloader.returncode}, ffmpeg {self.remuxer.returncode}):\n{log_tail}")
+            self.finished = True
+            self.condition.notify_all()
+
+    def wait_for(self, seconds=None):
+        # Chờ tới khi file có ít nhất `seconds` giây (None: chờ tải xong)
+        with self.condition:
+            while not self.finished and (seconds is None or self.available < seconds):
+                self.condition.wait(timeout=1)
+                check_cancelled()
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        for process in (self.downloader, self.remuxer):
+            if process.poll() is None:
+                process.kill()
+        for thread in self.threads:
+            thread.join()
+
 def download_thumbnail(thumbnail_url, dest_path):
     urllib.request.urlretrieve(thumbnail_url, dest_path)
     if not os.path.exists(dest_path):
         raise FileNotFoundError("Không tải được thumbnail")
 
-def build_ffmpeg_filter(layout, input_map, start, duration, text_item, font_path, part_num):
+@contextlib.contextmanager
+def file_lock(lock_path, stale_after=CACHE_LOCK_STALE_SECONDS, poll_interval=0.5):
+    # Khóa bằng file tạo với O_EXCL để dùng được trên cả Windows lẫn POSIX và giữa nhiều tiến trình
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(poll_interval)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def get_media_cache_dir(user_data_path):
+    cache_dir = os.path.join(user_data_path, "media_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def media_cache_key(video_id, format_string):
+    format_digest = hashlib.sha1(format_string.encode('utf-8')).hexdigest()[:12]
+    return f"{sanitize_filename(video_id)}_{format_digest}"
+
+@contextlib.contextmanager
+def cache_entry_in_use(entry_path):
+    # Đánh dấu entry đang được một job đọc để bước dọn LRU của job khác không xóa mất
+    marker_path = f"{entry_path}.inuse.{os.getpid()}.{threading.get_ident()}"
+    open(marker_path, 'w').close()
+    try:
+        yield entry_path
+    finally:
+        try:
+            os.remove(marker_path)
+        except OSError:
+            pass
+
+def is_cache_entry_in_use(entry_path):
+    in_use = False
+    for marker_path in glob.glob(glob.escape(entry_path) + ".inuse.*"):
+        try:
+            if time.time() - os.path.getmtime(marker_path) > CACHE_IN_USE_STALE_SECONDS:
+                os.remove(marker_path)
+            else:
+                in_use = True
+        except OSError:
+            pass
+    return in_use or os.path.exists(entry_path + ".lock")
+
+def fetch_media(entry_path, fetch, max_cache_bytes=None):
+    # Tải vào tên tạm rồi mới đổi tên, nên entry trong cache luôn là file hoàn chỉnh
+    with file_lock(entry_path + ".lock"):
+        if os.path.exists(entry_path):
+            os.utime(entry_path, None)
+            return True
+        root, ext = os.path.splitext(entry_path)
+        temp_path = f"{root}.partial{ext}"
+        try:
+            fetch(temp_path)
+            os.replace(temp_path, entry_path)
+        finally:
+            for leftover in glob.glob(glob.escape(root) + ".partial*"):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+    if max_cache_bytes:
+        evict_media_cache(os.path.dirname(entry_path), max_cache_bytes)
+    return False
+
+def plan_download_section(render_start, render_end, total_duration):
+    # Chỉ tải đoạn sẽ được render, nới thêm một khoảng để chắc chắn có keyframe trước điểm bắt đầu
+    section_start = max(0, math.floor(render_start - SECTION_KEYFRAME_MARGIN_SECONDS))
+    section_end = math.ceil(render_end + SECTION_KEYFRAME_MARGIN_SECONDS)
+    if section_start == 0 and section_end >= total_duration:
+        return None
+    return section_start, min(section_end, math.ceil(total_duration))
+
+def resolve_source_entry(media_dir, cache_key, section):
+    # Trả về (đường dẫn, đoạn mà file chứa). File tải từng đoạn mang hậu tố _<start>-<end>
+    # nên không bao giờ bị nhầm là bản đầy đủ; bản đầy đủ thì dùng được cho mọi đoạn.
+    full_path = os.path.join(media_dir, f"{cache_key}.mp4")
+    if not section or os.path.exists(full_path):
+        return full_path, None
+    pattern = re.compile(re.escape(cache_key) + r"_(\d+)-(\d+)\.mp4$")
+    for name in os.listdir(media_dir):
+        match = pattern.match(name)
+        if match and int(match.group(1)) <= section[0] and int(match.group(2)) >= section[1]:
+            return os.path.join(media_dir, name), (int(match.group(1)), int(match.group(2)))
+    return os.path.join(media_dir, f"{cache_key}_{section[0]}-{section[1]}.mp4"), section
+
+def evict_media_cache(cache_dir, max_cache_bytes):
+    with file_lock(os.path.join(cache_dir, "cache.lock"), stale_after=60):
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith(".lock") or ".partial" in name or ".inuse." in name:
+                continue
+            path = os.path.join(cache_dir, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= max_cache_bytes:
+                break
+            if is_cache_entry_in_use(path):
+                continue
+            try:
+                os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
+
+def build_source_input_args(source_path, start, duration, seek_mode):
+    # 'input': seek bằng -ss/-t trước -i (nhảy tới keyframe rồi cắt chính xác trong GOP),
+    # 'filter': giải mã từ đầu và cắt bằng trim/atrim trong filter graph.
+    if seek_mode == 'input':
+        return ['-ss', f"{start:.3f}", '-t', f"{duration:.3f}", '-i', source_path]
+    return ['-i', source_path]
+
+def build_drawtext_filter(text_item, font_path, part_num, enable=None):
+    style = text_item.get("textStyle", {})
+    font_size = style.get("fontSize", 70)
+    font_color = hex_to_ffmpeg_color(style.get("fontColor", "#FFFFFF"))
+    border_w = style.get("outlineWidth", 2)
+    border_color = hex_to_ffmpeg_color(style.get("outlineColor", "#000000"))
+    shadow_color = hex_to_ffmpeg_color(style.get("shadowColor", "#000000"), "80")
+    shadow_x = style.get("shadowDepth", 2)
+    shadow_y = style.get("shadowDepth", 2)
+    
+    text_x = text_item['x'] + (text_item['width'] / 2)
+    text_y = text_item['y'] + (text_item['height'] / 2)
+    
+    escaped_font_path = font_path.replace('\\', '/').replace(':', '\\:')
+
+    drawtext_filter = (
+        f"drawtext="
+        f"fontfile='{escaped_font_path}':"
+        f"text='Part {part_num}':"
+        f"fontsize={font_size}:"
+        f"fontcolor={font_color}:"
+        f"x={text_x}-(text_w/2):"
+        f"y={text_y}-(text_h/2):"
+        f"borderw={border_w}:"
+        f"bordercolor={border_color}:"
+        f"shadowcolor={shadow_color}:"
+        f"shadowx={shadow_x}:"
+        f"shadowy={shadow_y}"
+    )
+    if enable:
+        drawtext_filter += f":enable='{enable}'"
+    return drawtext_filter
+
+def build_ffmpeg_filter(layout, input_map, start, duration, text_item, font_path, part_num, seek_mode='input', part_segments=None, canvas_input=None,
+                        video_source=None, audio_source=None, label_prefix="", include_audio=True):
+    # video_source/audio_source: nhãn luồng đã được cắt sẵn (khi nhiều template dùng chung một lần giải mã)
+    video_trim = f"trim=start={start}:duration={duration}," if seek_mode == 'filter' else ""
+    audio_trim = f"atrim=start={start}:duration={duration}," if seek_mode == 'filter' else ""
+    p = label_prefix
     layout.sort(key=lambda x: int(x.get('zIndex', 0)))
-    filters, last_stream = ["color=s=720x1280:c=black[canvas]"], "canvas"
+    if canvas_input is None:
+        filters, last_stream = [f"color=s={CANVAS_WIDTH}x{CANVAS_HEIGHT}:c=black[{p}canvas]"], f"{p}canvas"
+    else:
+        # Ảnh nền chỉ giải mã và đổi định dạng một lần, filter loop lặp lại khung hình đó cho cả phần
+        filters, last_stream = [f"[{canvas_input}:v]format=yuv420p,loop=loop=-1:size=1:start=0[{p}canvas]"], f"{p}canvas"
     overlay_count = 0
+    video_used = False
     
     for item in layout:
         if item['type'] == 'text' or item['id'] not in input_map:
             continue
         input_index, w, h, x, y = input_map[item['id']], item['width'], item['height'], item['x'], item['y']
-        scaled_stream, output_stream = f"s{overlay_count}", f"bg{overlay_count + 1}"
+        scaled_stream, output_stream = f"{p}s{overlay_count}", f"{p}bg{overlay_count + 1}"
         scale_filter = f"scale={w}:{h},setsar=1"
-        if item['type'] == 'video':
-            filters.append(f"[{input_index}:v]trim=start={start}:duration={duration},setpts=PTS-STARTPTS,{scale_filter}[{scaled_stream}]")
+        if item.get('precomposed'):
+            # Lớp đã được ghép sẵn đúng kích thước khung hình, chỉ cần overlay
+            filters.append(f"[{last_stream}][{input_index}:v]overlay={x}:{y}[{output_stream}]")
+            last_stream, overlay_count = output_stream, overlay_count + 1
+            continue
+        if item['type'] == 'video' and video_source:
+            filters.append(f"[{video_source}]{scale_filter}[{scaled_stream}]")
+            video_used = True
+        elif item['type'] == 'video':
+            filters.append(f"[{input_index}:v]{video_trim}setpts=PTS-STARTPTS,{scale_filter}[{scaled_stream}]")
         else:
             filters.append(f"[{input_index}:v]{scale_filter}[{scaled_stream}]")
         filters.append(f"[{last_stream}][{scaled_stream}]overlay={x}:{y}[{output_stream}]")
         last_stream, overlay_count = output_stream, overlay_count + 1
 
+    if video_source and not video_used:
+        filters.append(f"[{video_source}]nullsink")
+
+    final_video = f"{p}final_v"
     if text_item:
-        style = text_item.get("textStyle", {})
-        font_size = style.get("fontSize", 70)
-        font_color = hex_to_ffmpeg_color(style.get("fontColor", "#FFFFFF"))
-        border_w = style.get("outlineWidth", 2)
-        border_color = hex_to_ffmpeg_color(style.get("outlineColor", "#000000"))
-        shadow_color = hex_to_ffmpeg_color(style.get("shadowColor", "#000000"), "80")
-        shadow_x = style.get("shadowDepth", 2)
-        shadow_y = style.get("shadowDepth", 2)
-        
-        text_x = text_item['x'] + (text_item['width'] / 2)
-        text_y = text_item['y'] + (text_item['height'] / 2)
-        
-        escaped_font_path = font_path.replace('\\', '/').replace(':', '\\:')
-
-        drawtext_filter = (
-            f"drawtext="
-            f"fontfile='{escaped_font_path}':"
-            f"text='Part {part_num}':"
-            f"fontsize={font_size}:"
-            f"fontcolor={font_color}:"
-            f"x={text_x}-(text_w/2):"
-            f"y={text_y}-(text_h/2):"
-            f"borderw={border_w}:"
-            f"bordercolor={border_color}:"
-            f"shadowcolor={shadow_color}:"
-            f"shadowx={shadow_x}:"
-            f"shadowy={shadow_y}"
-        )
-        
-        filters.append(f"[{last_stream}]{drawtext_filter}[final_v]")
-        last_stream = "final_v"
+        if part_segments:
+            # Render một lượt cho nhiều phần: mỗi nhãn "Part N" chỉ bật trong khoảng thời gian của phần đó
+            for seg_index, (seg_part_num, seg_start, seg_end) in enumerate(part_segments):
+                enable = f"gte(t,{seg_start:.3f})*lt(t,{seg_end:.3f})"
+                output_stream = f"{p}txt{seg_index}"
+                filters.append(f"[{last_stream}]{build_drawtext_filter(text_item, font_path, seg_part_num, enable)}[{output_stream}]")
+                last_stream = output_stream
+        else:
+            filters.append(f"[{last_stream}]{build_drawtext_filter(text_item, font_path, part_num)}[{final_video}]")
+            last_stream = final_video
     
-    if last_stream != "final_v":
-        filters.append(f"[{last_stream}]copy[final_v]")
+    if last_stream != final_video:
+        filters.append(f"[{last_stream}]copy[{final_video}]")
+
+    if not include_audio:
+        final_audio = None
+    elif audio_source:
+        final_audio = audio_source
+    else:
+        final_audio = f"{p}final_a"
+        filters.append(f"[0:a]{audio_trim}asetpts=PTS-STARTPTS[{final_audio}]")
+    return ";".join(filters), final_video, final_audio
+
+def build_render_graph(branches, start, duration, font_path, part_num, seek_mode='input', part_segments=None):
+    # Một template: graph như cũ. Nhiều template: giải mã nguồn một lần, split ra một nhánh layout cho mỗi template.
+    if len(branches) == 1:
+        branch = branches[0]
+        filter_complex, video_label, audio_label = build_ffmpeg_filter(
+            list(branch['layout']), branch['input_map'], start, duration, branch['text_item'], font_path, part_num,
+            seek_mode, part_segments, canvas_input=branch['canvas_input'])
+        return filter_complex, [(video_label, audio_label)]
+
+    count = len(branches)
+    video_trim = f"trim=start={start}:duration={duration}," if seek_mode == 'filter' else ""
+    audio_trim = f"atrim=start={start}:duration={duration}," if seek_mode == 'filter' else ""
+    filters = [
+        f"[0:v]{video_trim}setpts=PTS-STARTPTS,split={count}" + "".join(f"[src_v{i}]" for i in range(count)),
+        f"[0:a]{audio_trim}asetpts=PTS-STARTPTS,asplit={count}" + "".join(f"[src_a{i}]" for i in range(count)),
+    ]
+    outputs = []
+    for i, branch in enumerate(branches):
+        branch_filter, video_label, audio_label = build_ffmpeg_filter(
+            list(branch['layout']), branch['input_map'], start, duration, branch['text_item'], font_path, part_num,
+            seek_mode, part_segments, canvas_input=branch['canvas_input'],
+            video_source=f"src_v{i}", audio_source=f"src_a{i}", label_prefix=f"t{i}_")
+        filters.append(branch_filter)
+        outputs.append((video_label, audio_label))
+    return ";".join(filters), outputs
+
+class MissingAssetError(Exception):
+    pass
+
+def resolve_image_source(source):
+    # Ảnh có thể là data URL base64 hoặc đường dẫn file (kể cả dạng file://) do main.js truyền vào
+    if source.startswith('file://'):
+        return urllib.request.url2pathname(urllib.parse.urlparse(source).path)
+    return source
+
+def materialize_layout_images(layout, assets_dir):
+    # Mỗi ảnh chỉ giải mã một lần cho cả job; file được đặt tên theo hash nội dung nên
+    # ảnh trùng nhau giữa nhiều lớp hay nhiều template chỉ ghi ra đĩa một lần.
+    os.makedirs(assets_dir, exist_ok=True)
+    image_paths, materialized = {}, {}
+    for item in layout:
+        source = item.get('source')
+        if item['type'] != 'image' or not source:
+            continue
+        try:
+            if source not in materialized:
+                if source.startswith('data:image'):
+                    header, encoded = source.split(',', 1)
+                    image_format = header.split(';')[0].split('/')[1]
+                    image_data = base64.b64decode(encoded)
+                    asset_path = os.path.join(assets_dir, f"asset_{hashlib.sha1(image_data).hexdigest()[:16]}.{image_format}")
+                    if not os.path.exists(asset_path):
+                        with open(asset_path, 'wb') as img_f:
+                            img_f.write(image_data)
+                else:
+                    asset_path = resolve_image_source(source)
+                    if not os.path.isfile(asset_path):
+                        # Ảnh của template đã bị di chuyển/xóa: báo lỗi thay vì render thiếu lớp
+                        raise MissingAssetError(f"Không tìm thấy ảnh {item['id']}: {asset_path}")
+                materialized[source] = asset_path
+            image_paths[item['id']] = materialized[source]
+        except MissingAssetError:
+            raise
+        except Exception as e:
+            emit(f"Warning: Không thể xử lý ảnh {item['id']}: {e}")
+    return image_paths
+
+def compose_layer_image(ffmpeg_path, items, static_paths, dest_path, opaque):
+    canvas_color = "black" if opaque else "black@0.0"
+    cmd = [ffmpeg_path, '-y']
+    filters, last_stream = [f"color=s={CANVAS_WIDTH}x{CANVAS_HEIGHT}:c={canvas_color},format=rgba[canvas]"], "canvas"
+    for index, item in enumerate(items):
+        cmd += ['-i', static_paths[item['id']]]
+        filters.append(f"[{index}:v]scale={item['width']}:{item['height']},setsar=1[s{index}]")
+        filters.append(f"[{last_stream}][s{index}]overlay={item['x']}:{item['y']}:format=rgb[l{index}]")
+        last_stream = f"l{index}"
+    cmd += ['-filter_complex', ";".join(filters), '-map', f'[{last_stream}]', '-frames:v', '1', '-pix_fmt', 'rgba', dest_path]
+    run_command_with_live_output(cmd)
+
+def precompose_static_layers(ffmpeg_path, layout, static_paths, temp_dir):
+    # Chỉ lớp video thay đổi theo thời gian; thumbnail và ảnh được ghép sẵn một lần mỗi job thành
+    # ảnh nền (dưới video) và ảnh tiền cảnh (trên video), giữ nguyên thứ tự zIndex.
+    ordered = sorted(layout, key=lambda x: int(x.get('zIndex', 0)))
+    video_index = next((i for i, item in enumerate(ordered) if item['type'] == 'video'), len(ordered))
+    is_static = lambda item: item['type'] not in ('text', 'video') and item['id'] in static_paths
+    below = [item for item in ordered[:video_index] if is_static(item)]
+    above = [item for item in ordered[video_index + 1:] if is_static(item)]
+
+    background_path = os.path.join(temp_dir, "layer_background.png")
+    compose_layer_image(ffmpeg_path, below, static_paths, background_path, opaque=True)
+    foreground_path = None
+    if above:
+        foreground_path = os.path.join(temp_dir, "layer_foreground.png")
+        compose_layer_image(ffmpeg_path, above, static_paths, foreground_path, opaque=False)
+    return background_path, foreground_path
+
+def build_layer_inputs(layout, background_path, foreground_path, first_index=1):
+    # Trả về (tham số -i, input_map, layout rút gọn) cho graph mỗi phần: nền + video + tiền cảnh
+    layer_args = ['-i', background_path]
+    input_map = {'video-placeholder': 0}
+    video_item = next((item for item in layout if item['type'] == 'video'), None)
+    composited_layout = [dict(video_item)] if video_item else []
+    if foreground_path:
+        layer_args += ['-i', foreground_path]
+        input_map[FOREGROUND_LAYER_ID] = first_index + 1
+        composited_layout.append({
+            'id': FOREGROUND_LAYER_ID, 'type': 'image', 'precomposed': True,
+            'x': 0, 'y': 0, 'width': CANVAS_WIDTH, 'height': CANVAS_HEIGHT,
+            'zIndex': int(video_item.get('zIndex', 0)) + 1 if video_item else 0,
+        })
+    return layer_args, input_map, composited_layout
+
+def load_templates(layout_files):
+    # Mỗi --layout-file là một layout (danh sách phần tử) hoặc manifest {"templates": [{"name": ..., "layout": [...]}]}.
+    # Chế độ server truyền thẳng dữ liệu đã parse thay cho đường dẫn file.
+    templates, used_names = [], set()
+    for layout_file in layout_files:
+        if isinstance(layout_file, str):
+            with open(layout_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            base_name = os.path.splitext(os.path.basename(layout_file))[0]
+        else:
+            data, base_name = layout_file, "layout"
+        if isinstance(data, dict):
+            entries = [(t.get('name') or f"{base_name}_{i + 1}", t['layout']) for i, t in enumerate(data.get('templates', []))]
+        else:
+            entries = [(base_name, data)]
+        for name, layout in entries:
+            name = sanitize_filename(str(name)).strip() or f"template_{len(templates) + 1}"
+            if name in used_names:
+                name = f"{name}_{len(templates) + 1}"
+            used_names.add(name)
+            templates.append((name, layout))
+    if not templates:
+        raise Exception("Không có layout nào để render.")
+    return templates
+
+def template_output_base(output_dir, sanitized_title, templates, name):
+    output_name = sanitized_title if len(templates) == 1 else f"{sanitized_title}_{name}"
+    return os.path.join(output_dir, output_name)
 
-    filters.append(f"[0:a]atrim=start={start}:duration={duration},asetpts=PTS-STARTPTS[final_a]")
-    return ";".join(filters), "final_v"
+def partial_output_path(output_path):
+    # ffmpeg ghi vào tên tạm rồi mới đổi tên, file bị ngắt giữa chừng không bao giờ mang tên file hoàn chỉnh
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.partial{ext}"
 
-def process_video(url, num_parts, save_path, part_duration, layout_file, encoder, resources_path, user_data_path):
-    with open(layout_file, 'r', encoding='utf-8') as f:
-        layout = json.load(f)
+def prepare_template_branches(ffmpeg_path, templates, thumbnail_path, output_dir, sanitized_title, temp_dir):
+    # Mỗi template có ảnh nền/tiền cảnh riêng; các input được xếp nối tiếp sau video nguồn (input 0)
+    assets_dir = os.path.join(temp_dir, "assets")
+    layer_args, branches, next_index = [], [], 1
+    for index, (name, layout) in enumerate(templates):
+        static_paths = {'thumbnail-placeholder': thumbnail_path, **materialize_layout_images(layout, assets_dir)}
+        layers_dir = os.path.join(temp_dir, f"layers_{index}")
+        os.makedirs(layers_dir, exist_ok=True)
+        background_path, foreground_path = precompose_static_layers(ffmpeg_path, layout, static_paths, layers_dir)
+        args, input_map, composited_layout = build_layer_inputs(layout, background_path, foreground_path, next_index)
+        branches.append({
+            'layout': composited_layout, 'input_map': input_map, 'canvas_input': next_index,
+            'text_item': next((item for item in layout if item['type'] == 'text'), None),
+            'output_base': template_output_base(output_dir, sanitized_title, templates, name),
+        })
+        layer_args += args
+        next_index += len(args) // 2
+    return layer_args, branches
+
+def build_encoder_args(encoder):
+    if encoder == 'libx264':
+        return ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+    return ['-c:v', encoder, '-preset', 'p7', '-cq', '23']
+
+def build_output_args(encoder, threads=None):
+    args = build_encoder_args(encoder)
+    if threads:
+        args += ['-threads', str(threads)]
+    return args + ['-c:a', 'aac', '-b:a', '192k', '-r', '30', '-shortest']
+
+def render_part(ffmpeg_path, main_video_path, layer_args, branches, font_path, part_num, num_parts,
+                start_time, part_duration, encoder, seek_mode, threads=None):
+    output_paths = [f"{branch['output_base']}_Part_{part_num}.mp4" for branch in branches]
+    emit(f"STATUS: Render Part {part_num}/{num_parts}...")
     
-    output_dir = save_path or os.path.join(resources_path, "output")
-    temp_dir = os.path.join(resources_path, "temp_files")
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(temp_dir, exist_ok=True)
+    cmd = [ffmpeg_path, '-y']
+    if threads:
+        cmd += ['-filter_complex_threads', str(threads), '-threads', str(threads)]
+    cmd += build_source_input_args(main_video_path, start_time, part_duration, seek_mode) + layer_args
+
+    filter_complex, outputs = build_render_graph(branches, start_time, part_duration, font_path, part_num, seek_mode)
+    cmd += ['-filter_complex', filter_complex]
+    for (video_label, audio_label), output_path in zip(outputs, output_paths):
+        cmd += ['-map', f'[{video_label}]', '-map', f'[{audio_label}]'] + build_output_args(encoder, threads) + [partial_output_path(output_path)]
+    
+    run_command_with_live_output(cmd, label=f"Part {part_num}" if threads else None,
+                                 progress={'part': part_num, 'duration': part_duration})
+
+    for output_path in output_paths:
+        os.replace(partial_output_path(output_path), output_path)
+        emit(f"RESULT:{output_path}")
+
+def render_parts_single_pass(ffmpeg_path, main_video_path, layer_args, branches, font_path,
+                             num_parts, part_duration, encoder, seek_mode, source_start=0):
+    # Giải mã video nguồn và dựng layout một lần duy nhất, segment muxer cắt ra từng phần
+    render_duration = num_parts * part_duration
+    part_segments = [(i + 1, i * part_duration, (i + 1) * part_duration) for i in range(num_parts)]
+    boundaries = ",".join(f"{i * part_duration:.3f}" for i in range(1, num_parts))
+    emit(f"STATUS: Render {num_parts} phần trong một lượt...")
+
+    cmd = [ffmpeg_path, '-y'] + build_source_input_args(main_video_path, source_start, render_duration, seek_mode) + layer_args
+
+    filter_complex, outputs = build_render_graph(branches, source_start, render_duration, font_path, None, seek_mode, part_segments)
+    cmd += ['-filter_complex', filter_complex]
+    for (video_label, audio_label), branch in zip(outputs, branches):
+        output_pattern = f"{branch['output_base'].replace('%', '%%')}_Part_%d.partial.mp4"
+        cmd += ['-map', f'[{video_label}]', '-map', f'[{audio_label}]'] + build_output_args(encoder)
+        if num_parts > 1:
+            cmd += ['-force_key_frames', boundaries, '-segment_times', boundaries]
+        cmd += ['-f', 'segment', '-segment_format', 'mp4', '-reset_timestamps', '1', '-segment_start_number', '1', output_pattern]
+
+    run_command_with_live_output(cmd, progress={'part': None, 'duration': render_duration})
+
+    for branch in branches:
+        for part_num in range(1, num_parts + 1):
+            output_path = f"{branch['output_base']}_Part_{part_num}.mp4"
+            if os.path.exists(partial_output_path(output_path)):
+                os.replace(partial_output_path(output_path), output_path)
+                emit(f"RESULT:{output_path}")
+
+def is_passthrough_layout(layout):
+    # Video phủ kín khung hình, không có chữ và không có lớp nào nằm trên video: không cần xử lý điểm ảnh
+    ordered = sorted(layout, key=lambda x: int(x.get('zIndex', 0)))
+    video_index = next((i for i, item in enumerate(ordered) if item['type'] == 'video'), None)
+    if video_index is None or any(item['type'] == 'text' for item in ordered):
+        return False
+    video_item = ordered[video_index]
+    if (video_item['x'], video_item['y'], video_item['width'], video_item['height']) != (0, 0, CANVAS_WIDTH, CANVAS_HEIGHT):
+        return False
+    return not any(item['type'] in ('image', 'thumbnail') for item in ordered[video_index + 1:])
+
+def run_ffprobe_json(ffprobe_path, args):
+    cmd = [ffprobe_path, '-v', 'error', '-of', 'json'] + args
+    process = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+    if process.returncode != 0:
+        raise Exception(f"ffprobe lỗi với mã {process.returncode}:\n{process.stderr}")
+    return json.loads(process.stdout)
+
+def probe_video_size(ffprobe_path, source_path):
+    streams = run_ffprobe_json(ffprobe_path, ['-select_streams', 'v:0', '-show_entries', 'stream=width,height', source_path]).get('streams') or [{}]
+    return streams[0].get('width'), streams[0].get('height')
+
+def probe_keyframe_times(ffprobe_path, source_path):
+    # Đọc cờ keyframe từ packet (không cần giải mã), quy về mốc tính từ đầu file như -ss của ffmpeg
+    data = run_ffprobe_json(ffprobe_path, ['-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags:format=start_time', source_path])
+    start_time = float(data.get('format', {}).get('start_time') or 0)
+    return sorted(float(packet['pts_time']) - start_time for packet in data.get('packets', [])
+                  if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A'))
+
+def snap_to_keyframe(time_point, keyframes):
+    if not keyframes:
+        return time_point
+    index = bisect.bisect_left(keyframes, time_point)
+    candidates = keyframes[max(0, index - 1):index + 1]
+    return min(candidates, key=lambda k: abs(k - time_point))
+
+def render_parts_stream_copy(ffmpeg_path, ffprobe_path, main_video_path, num_parts, part_duration, source_offset, output_dir, sanitized_title,
+                             manifest=None):
+    emit("STATUS: Layout không cần xử lý hình, cắt trực tiếp theo keyframe (không encode)...")
+    keyframes = probe_keyframe_times(ffprobe_path, main_video_path)
+    # Điểm đầu mỗi phần được dời về keyframe gần nhất; phần cuối kết thúc đúng ở mốc yêu cầu
+    cuts = [snap_to_keyframe(i * part_duration - source_offset, keyframes) for i in range(num_parts)]
+    cuts.append(num_parts * part_duration - source_offset)
+    for i in range(num_parts):
+        part_num, start, end = i + 1, cuts[i], cuts[i + 1]
+        if end <= start:
+            emit(f"STATUS: Bỏ qua Part {part_num}: không có keyframe trong khoảng cắt.")
+            continue
+        output_path = os.path.join(output_dir, f"{sanitized_title}_Part_{part_num}.mp4")
+        input_hash = hash_render_inputs({'mode': 'stream-copy', 'source': os.path.basename(main_video_path), 'start': start, 'end': end})
+        if manifest is not None and manifest.is_done(output_path, input_hash):
+            emit(f"STATUS: Part {part_num} đã có sẵn, bỏ qua.")
+            emit(f"RESULT:{output_path}")
+            continue
+        emit(f"STATUS: Cắt Part {part_num}/{num_parts}: {start + source_offset:.3f}s - {end + source_offset:.3f}s")
+        # -ss lệch nhẹ về sau keyframe để ffmpeg không lùi về keyframe trước đó do làm tròn
+        cmd = [ffmpeg_path, '-y', '-ss', f"{start + 0.001:.3f}", '-i', main_video_path, '-t', f"{end - start:.3f}",
+               '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-avoid_negative_ts', 'make_zero', partial_output_path(output_path)]
+        run_command_with_live_output(cmd, progress={'part': part_num, 'duration': end - start})
+        os.replace(partial_output_path(output_path), output_path)
+        if manifest is not None:
+            manifest.record(output_path, input_hash)
+        emit(f"RESULT:{output_path}")
+
+def hash_render_inputs(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
 
-    yt_dlp_path = get_executable_path("yt-dlp", resources_path)
-    ffmpeg_path = get_executable_path("ffmpeg", resources_path)
-    font_path = get_font_path(resources_path)
+def is_valid_output(ffprobe_path, output_path):
+    # File hợp lệ khi ffprobe đọc được, có luồng video và thời lượng dương (file bị cắt cụt thiếu moov atom)
+    try:
+        data = run_ffprobe_json(ffprobe_path, ['-show_entries', 'format=duration:stream=codec_type', output_path])
+    except Exception:
+        return False
+    has_video = any(stream.get('codec_type') == 'video' for stream in data.get('streams', []))
+    return has_video and float(data.get('format', {}).get('duration') or 0) > 0
+
+class RenderManifest:
+    # Manifest cạnh các file output: mã băm đầu vào và kích thước của từng phần đã render xong,
+    # chạy lại job sẽ bỏ qua những phần không đổi thay vì render lại từ đầu.
+    def __init__(self, manifest_path, ffprobe_path):
+        self.manifest_path = manifest_path
+        self.ffprobe_path = ffprobe_path
+        self.lock = threading.Lock()
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                self.outputs = json.load(f).get('outputs', {})
+        except (OSError, ValueError):
+            self.outputs = {}
+
+    def is_done(self, output_path, input_hash):
+        entry = self.outputs.get(os.path.basename(output_path))
+        if not entry or entry.get('hash') != input_hash:
+            return False
+        try:
+            if os.path.getsize(output_path) != entry.get('size'):
+                return False
+        except OSError:
+            return False
+        return is_valid_output(self.ffprobe_path, output_path)
+
+    def record(self, output_path, input_hash):
+        with self.lock:
+            self.outputs[os.path.basename(output_path)] = {'hash': input_hash, 'size': os.path.getsize(output_path)}
+            partial_path = self.manifest_path + ".partial"
+            with open(partial_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'outputs': self.outputs}, f, ensure_ascii=False, indent=2)
+            os.replace(partial_path, self.manifest_path)
+
+def select_cookies_path(cookie_paths):
+    # File cookies người dùng cập nhật (userData) được ưu tiên hơn file đi kèm app
+    return next((path for path in cookie_paths if os.path.exists(path)), cookie_paths[-1])
+
+def build_runtime(resources_path, user_data_path, save_path="", cache_size_gb=20, downloader='auto', aria2c_connections=16, aria2c_split_size='1M',
+                  metadata_ttl_hours=3, metadata_backend='auto'):
+    # Đường dẫn công cụ và cấu hình dùng chung cho mọi video trong một lần chạy
     user_cookie_path = os.path.join(user_data_path, 'cookies.txt')
     default_cookie_path = os.path.join(resources_path, "cookies.txt")
-    cookies_path_to_use = user_cookie_path if os.path.exists(user_cookie_path) else default_cookie_path
+    runtime = {
+        'yt_dlp_path': get_executable_path("yt-dlp", resources_path),
+        'ffmpeg_path': get_executable_path("ffmpeg", resources_path),
+        'ffprobe_path': get_executable_path("ffprobe", resources_path),
+        'font_path': get_font_path(resources_path),
+        'cookies_path': select_cookies_path([user_cookie_path, default_cookie_path]),
+        # Server chạy lâu chọn lại file cookies cho mỗi job vì người dùng có thể cập nhật cookies giữa chừng
+        'cookie_paths': [user_cookie_path, default_cookie_path],
+        'output_dir': save_path or os.path.join(resources_path, "output"),
+        'temp_root': os.path.join(resources_path, "temp_files"),
+        'logs_dir': os.path.join(user_data_path, "logs"),
+        'preview_dir': os.path.join(user_data_path, "preview_cache"),
+        'metadata_dir': os.path.join(user_data_path, "metadata_cache"),
+        'metadata_ttl_seconds': metadata_ttl_hours * 3600,
+        'metadata_backend': 'module' if metadata_backend != 'process' and yt_dlp is not None else 'process',
+        'media_dir': get_media_cache_dir(user_data_path) if cache_size_gb > 0 else None,
+        'max_cache_bytes': int(cache_size_gb * 1024 ** 3) if cache_size_gb > 0 else None,
+        'downloader_args': build_downloader_args(resources_path, downloader, aria2c_connections, aria2c_split_size),
+    }
+    os.makedirs(runtime['output_dir'], exist_ok=True)
+    return runtime
 
-    try:
-        print("STATUS: Lấy thông tin video...", flush=True)
-        video_info = fetch_video_metadata(url, yt_dlp_path, cookies_path_to_use)
-        title, video_id, thumbnail_url, total_duration = video_info['title'], video_info['id'], video_info['thumbnail'], video_info.get('duration', 0)
-        if not total_duration: raise Exception("Không lấy được thông tin thời lượng video.")
-        sanitized_title = sanitize_filename(title)
-        if part_duration <= 0: part_duration = total_duration / num_parts
-        
-        print("STATUS: Tải video chính...", flush=True)
-        main_video_path = os.path.join(temp_dir, f"{video_id}.mp4")
-        if not os.path.exists(main_video_path):
-             download_main_video(url, yt_dlp_path, ffmpeg_path, main_video_path, cookies_path_to_use)
-        
-        print("STATUS: Tải thumbnail...", flush=True)
-        thumbnail_path = os.path.join(temp_dir, f"{video_id}_thumb.jpg")
-        if not os.path.exists(thumbnail_path):
-            download_thumbnail(thumbnail_url, thumbnail_path)
-        
-        text_item = next((item for item in layout if item['type'] == 'text'), None)
-        actual_num_parts = min(num_parts, int(total_duration // part_duration))
-        
-        for i in range(actual_num_parts):
-            part_num = i + 1
-            start_time = i * part_duration
-            if start_time >= total_duration: break
-            
-            output_path = os.path.join(output_dir, f"{sanitized_title}_Part_{part_num}.mp4")
-            print(f"STATUS: Render Part {part_num}/{actual_num_parts}...", flush=True)
-            
-            cmd = [ffmpeg_path, '-y', '-i', main_video_path, '-i', thumbnail_path]
-            input_map = {'video-placeholder': 0, 'thumbnail-placeholder': 1}
-            
-            image_index = 2
-            for item in layout:
-                if item['type'] == 'image' and item['source'] and item['source'].startswith('data:image'):
-                    try:
-                        header, encoded = item['source'].split(',', 1)
-                        image_format = header.split(';')[0].split('/')[1]
-                        image_data = base64.b64decode(encoded)
-                        temp_image_path = os.path.join(temp_dir, f"temp_img_{item['id']}.{image_format}")
-                        with open(temp_image_path, 'wb') as img_f:
-                            img_f.write(image_data)
-                        cmd += ['-i', temp_image_path]
-                        input_map[item['id']] = image_index
-                        image_index += 1
-                    except Exception as e:
-                        print(f"Warning: Không thể xử lý ảnh {item['id']}: {e}")
+def prepare_source(url, templates, options, runtime, temp_dir, cache_leases):
+    # Giai đoạn tải: metadata, video chính và thumbnail. Trả về thông tin cần cho giai đoạn render.
+    media_dir = runtime['media_dir'] or temp_dir
+    max_cache_bytes = runtime['max_cache_bytes']
 
-            filter_complex, final_video_stream = build_ffmpeg_filter(layout, input_map, start_time, part_duration, text_item, font_path, part_num)
-            
-            cmd += ['-filter_complex', filter_complex, '-map', f'[{final_video_stream}]', '-map', '[final_a]']
-            
-            if encoder == 'libx264':
-                cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
-            else:
-                cmd += ['-c:v', encoder, '-preset', 'p7', '-cq', '23']
-                
-            cmd += ['-c:a', 'aac', '-b:a', '192k', '-r', '30', '-shortest', output_path]
-            
-            run_command_with_live_output(cmd)
+    emit("STATUS: Lấy thông tin video...")
+    video_info, info_path = get_video_metadata(url, runtime, temp_dir)
+    title, video_id, thumbnail_url, total_duration = video_info['title'], video_info['id'], video_info['thumbnail'], video_info.get('duration', 0)
+    if not total_duration: raise Exception("Không lấy được thông tin thời lượng video.")
+    part_duration = options['part_duration']
+    if part_duration <= 0: part_duration = total_duration / options['num_parts']
+    actual_num_parts = min(options['num_parts'], int(total_duration // part_duration))
+    render_start, render_end = 0, actual_num_parts * part_duration
+    
+    emit("STATUS: Tải video chính...")
+    format_string = select_video_format([layout for _, layout in templates], video_info, options['quality_headroom'])
+    section = plan_download_section(render_start, render_end, total_duration)
+    source_path, section = resolve_source_entry(media_dir, media_cache_key(video_id, format_string), section)
+    main_video_path = cache_leases.enter_context(cache_entry_in_use(source_path))
+    stream = None
+    if options['streaming'] and options['render_mode'] == 'per-part' and not options['stream_copy'] and not os.path.exists(main_video_path):
+        # Chưa có trong cache: tải dạng stream vào file TS tạm thay vì chờ file mp4 hoàn chỉnh.
+        # Stream luôn bắt đầu từ đầu video nên không dùng --download-sections.
+        emit("STATUS: Tải video dạng stream, render ngay khi đủ dữ liệu...")
+        section = None
+        stream = StreamingDownload(url, runtime, format_string, info_path,
+                                   os.path.join(temp_dir, f"{media_cache_key(video_id, format_string)}.stream.ts"), render_end)
+        cache_leases.callback(stream.close)
+        main_video_path = stream.dest_path
+    elif fetch_media(main_video_path, lambda dest: download_main_video(url, runtime['yt_dlp_path'], runtime['ffmpeg_path'], dest, runtime['cookies_path'],
+                                                                      format_string, runtime['downloader_args'], section, info_path), max_cache_bytes):
+        emit("STATUS: Dùng video chính đã có trong cache.")
 
-            print(f"RESULT:{output_path}", flush=True)
-        
-        print("STATUS: Hoàn tất tất cả các phần!", flush=True)
+    thumbnail_path = None
+    if not options['stream_copy']:
+        emit("STATUS: Tải thumbnail...")
+        thumbnail_path = cache_leases.enter_context(cache_entry_in_use(
+            os.path.join(media_dir, f"{sanitize_filename(video_id)}_thumb.jpg")))
+        fetch_media(thumbnail_path, lambda dest: download_thumbnail(thumbnail_url, dest), max_cache_bytes)
+
+    return {
+        'video_id': video_id, 'sanitized_title': sanitize_filename(title), 'total_duration': total_duration,
+        'num_parts': actual_num_parts, 'part_duration': part_duration, 'render_start': render_start,
+        # Mốc thời gian của từng phần được tính lại theo đầu file khi chỉ tải một đoạn
+        'source_offset': section[0] if section else 0,
+        'main_video_path': main_video_path, 'thumbnail_path': thumbnail_path,
+        'source_key': os.path.basename(source_path), 'stream': stream,
+    }
 
-    except Exception as e:
-        print(f"PYTHON_ERROR: {e}", file=sys.stderr, flush=True)
-        sys.exit(1)
+def render_source(source, templates, options, runtime, temp_dir):
+    # Giai đoạn render: cắt stream copy nếu layout không cần xử lý hình, ngược lại dựng graph và encode
+    ffmpeg_path, ffprobe_path, font_path = runtime['ffmpeg_path'], runtime['ffprobe_path'], runtime['font_path']
+    main_video_path, source_offset = source['main_video_path'], source['source_offset']
+    num_parts, part_duration = source['num_parts'], source['part_duration']
+    output_dir, sanitized_title = runtime['output_dir'], source['sanitized_title']
+    jobs = options['jobs']
+    # Mỗi lần render một nguồn là một job mới về mặt tiến độ
+    _render_progress.set(RenderProgress(num_parts * part_duration))
+    manifest = RenderManifest(os.path.join(output_dir, f".{sanitized_title}.manifest.json"), ffprobe_path)
+    stream = source.get('stream')
+    seek_mode = 'input' if stream else options['seek_mode']
+    if stream and len(templates) == 1 and is_passthrough_layout(templates[0][1]):
+        # Có thể cắt stream copy: cần file hoàn chỉnh để dò keyframe
+        stream.wait_for()
+
+    if options['stream_copy'] or (len(templates) == 1 and is_passthrough_layout(templates[0][1])
+                                  and probe_video_size(ffprobe_path, main_video_path) == (CANVAS_WIDTH, CANVAS_HEIGHT)):
+        render_parts_stream_copy(ffmpeg_path, ffprobe_path, main_video_path, num_parts, part_duration, source_offset,
+                                 output_dir, sanitized_title, manifest)
+        return
+
+    # Mã băm đầu vào của mỗi phần: nguồn, layout, mốc cắt, cài đặt encode và font
+    render_inputs = {
+        'source': source['source_key'], 'thumbnail': source['video_id'],
+        'templates': templates, 'part_duration': part_duration, 'output_args': build_output_args(options['encoder']),
+        'seek_mode': seek_mode, 'render_mode': options['render_mode'], 'font': font_path,
+    }
+    output_bases = [template_output_base(output_dir, sanitized_title, templates, name) for name, _ in templates]
+    parts = [(i + 1, i * part_duration - source_offset) for i in range(num_parts) if i * part_duration < source['total_duration']]
+    part_outputs = {part_num: [f"{base}_Part_{part_num}.mp4" for base in output_bases] for part_num, _ in parts}
+    part_hashes = {part_num: hash_render_inputs(dict(render_inputs, part=part_num, start=start_time)) for part_num, start_time in parts}
+    done_parts = {part_num for part_num, _ in parts
+                  if all(manifest.is_done(path, part_hashes[part_num]) for path in part_outputs[part_num])}
+    if options['render_mode'] == 'single-pass' and len(done_parts) < len(parts):
+        # Segment muxer cắt mọi phần trong một lượt nên chỉ bỏ qua được khi tất cả các phần đã có
+        done_parts = set()
+    for part_num in sorted(done_parts):
+        emit(f"STATUS: Part {part_num} đã có sẵn, bỏ qua.")
+        for output_path in part_outputs[part_num]:
+            emit(f"RESULT:{output_path}")
+    pending = [part for part in parts if part[0] not in done_parts]
+    if not pending:
+        return
+
+    emit("STATUS: Ghép sẵn các lớp ảnh tĩnh...")
+    # Ảnh được giải mã và ghép một lần trước khi render, các worker chỉ đọc kết quả.
+    # Mỗi template là một nhánh trong cùng một tiến trình ffmpeg.
+    layer_args, branches = prepare_template_branches(ffmpeg_path, templates, source['thumbnail_path'], output_dir, sanitized_title, temp_dir)
+
+    if options['render_mode'] == 'single-pass':
+        render_parts_single_pass(ffmpeg_path, main_video_path, layer_args, branches, font_path,
+                                 num_parts, part_duration, options['encoder'], options['seek_mode'],
+                                 source_start=source['render_start'] - source_offset)
+        for part_num, _ in parts:
+            for output_path in part_outputs[part_num]:
+                if os.path.exists(output_path):
+                    manifest.record(output_path, part_hashes[part_num])
+        return
+
+    threads_per_job = max(1, (os.cpu_count() or 1) // jobs) if jobs > 1 else None
+
+    def render_one(part):
+        part_num, start_time = part
+        if stream:
+            # File TS dùng mốc thời gian của video gốc (stream không cắt đoạn nên source_offset = 0)
+            stream.wait_for(min(start_time + part_duration + STREAM_MARGIN_SECONDS, source['num_parts'] * part_duration))
+        render_part(ffmpeg_path, main_video_path, layer_args, branches, font_path, part_num, len(parts),
+                    start_time, part_duration, options['encoder'], seek_mode, threads_per_job)
+        for output_path in part_outputs[part_num]:
+            manifest.record(output_path, part_hashes[part_num])
+
+    if jobs <= 1:
+        for part in pending:
+            render_one(part)
+        return
+
+    # Các worker chạy trong nhóm tiến trình riêng để khi một phần lỗi chỉ dừng các ffmpeg của video này
+    part_processes = set()
+    group_token = _process_group.set(_process_group.get() + (part_processes,))
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, render_one, part) for part in pending]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = next((f for f in done if f.exception()), None)
+            if failed:
+                for future in futures:
+                    future.cancel()
+                terminate_active_processes(part_processes)
+                raise failed.exception()
     finally:
-        print("STATUS: Dọn dẹp file tạm...", flush=True)
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        _process_group.reset(group_token)
+
+def build_options(num_parts=1, part_duration=0, encoder='libx264', seek_mode='input', render_mode='per-part', jobs=1,
+                  quality_headroom=1.0, stream_copy=False, streaming=False):
+    return {
+        'num_parts': num_parts, 'part_duration': part_duration, 'encoder': encoder, 'seek_mode': seek_mode,
+        'render_mode': render_mode, 'jobs': jobs, 'quality_headroom': quality_headroom, 'stream_copy': stream_copy,
+        'streaming': streaming,
+    }
+
+def process_video(url, num_parts, save_path, part_duration, layout_files, encoder, resources_path, user_data_path, seek_mode='input', render_mode='per-part', jobs=1, cache_size_gb=20,
+                  downloader='auto', aria2c_connections=16, aria2c_split_size='1M', quality_headroom=1.0,
+                  stream_copy=False, metadata_ttl_hours=3, metadata_backend='auto', streaming=False):
+    if isinstance(layout_files, str):
+        layout_files = [layout_files]
+    templates = load_templates(layout_files)
+    options = build_options(num_parts, part_duration, encoder, seek_mode, render_mode, jobs, quality_headroom, stream_copy, streaming)
+    runtime = build_runtime(resources_path, user_data_path, save_path, cache_size_gb, downloader, aria2c_connections, aria2c_split_size,
+                            metadata_ttl_hours, metadata_backend)
+    temp_dir = runtime['temp_root']
+    os.makedirs(temp_dir, exist_ok=True)
+    cache_leases = contextlib.ExitStack()
+
+    with job_log(runtime['logs_dir'], job_log_name("job")) as log_path:
+        try:
+            source = prepare_source(url, templates, options, runtime, temp_dir, cache_leases)
+            render_source(source, templates, options, runtime, temp_dir)
+            emit("STATUS: Hoàn tất tất cả các phần!")
+
+        except Exception as e:
+            emit(f"PYTHON_ERROR: {e} (log: {log_path})", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            cache_leases.close()
+            emit("STATUS: Dọn dẹp file tạm...")
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+def process_batch(urls, layout_files, options, runtime, queue_size=1):
+    with job_log(runtime['logs_dir'], job_log_name("batch")):
+        return run_batch(urls, layout_files, options, runtime, queue_size)
+
+def run_batch(urls, layout_files, options, runtime, queue_size=1):
+    # Pipeline hai giai đoạn: luồng tải chạy trước tối đa queue_size video trong khi luồng chính render,
+    # để mạng không ngồi chờ CPU và ngược lại. Mọi dòng in ra được gắn nhãn ITEM:<số thứ tự>:.
+    templates = load_templates(layout_files)
+    render_queue = queue.Queue(maxsize=max(1, queue_size))
+    failures = []
+
+    def cleanup(cache_leases, temp_dir):
+        cache_leases.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def download_worker():
+        # Sentinel luôn được gửi, kể cả khi luồng tải gặp lỗi ngoài dự kiến, để luồng render không chờ mãi
+        reached = 0
+        try:
+            for index, url in enumerate(urls, 1):
+                reached = index
+                # Job bị hủy: dừng hẳn vòng tải, video này và các video còn lại được tính là lỗi ở dưới
+                check_cancelled()
+                _emit_tag.set(index)
+                temp_dir = os.path.join(runtime['temp_root'], f"item_{index}")
+                cache_leases = contextlib.ExitStack()
+                try:
+                    os.makedirs(temp_dir, exist_ok=True)
+                    source = prepare_source(url, templates, options, runtime, temp_dir, cache_leases)
+                except Exception as e:
+                    emit(f"PYTHON_ERROR: {e}", file=sys.stderr)
+                    failures.append(index)
+                    cleanup(cache_leases, temp_dir)
+                    continue
+                render_queue.put((index, source, cache_leases, temp_dir))
+        except Exception as e:
+            _emit_tag.set(None)
+            emit(f"PYTHON_ERROR: Luồng tải dừng: {e}", file=sys.stderr)
+            # Video đang tải dở và các video chưa tới lượt đều tính là lỗi
+            failures.extend(index for index in range(max(1, reached), len(urls) + 1) if index not in failures)
+        finally:
+            render_queue.put(None)
+
+    emit(f"STATUS: Bắt đầu batch {len(urls)} video...")
+    # Luồng tải chạy trong bản sao context để ghi chung log của batch
+    downloader_thread = threading.Thread(target=contextvars.copy_context().run, args=(download_worker,), daemon=True)
+    downloader_thread.start()
+    while True:
+        entry = render_queue.get()
+        if entry is None:
+            break
+        index, source, cache_leases, temp_dir = entry
+        tag_token = _emit_tag.set(index)
+        try:
+            check_cancelled()
+            render_source(source, templates, options, runtime, temp_dir)
+            emit("STATUS: Hoàn tất tất cả các phần!")
+        except Exception as e:
+            emit(f"PYTHON_ERROR: {e}", file=sys.stderr)
+            failures.append(index)
+        finally:
+            cleanup(cache_leases, temp_dir)
+            _emit_tag.reset(tag_token)
+    downloader_thread.join()
+    emit(f"STATUS: Batch hoàn tất: {len(urls) - len(failures)}/{len(urls)} video thành công.")
+    return sorted(failures)
+
+def send_event(event):
+    with _output_lock:
+        print(json.dumps(event, ensure_ascii=False), flush=True)
+
+def parse_event_line(message, job_id):
+    # Chuyển các dòng STATUS:/PROGRESS:/RESULT:/PYTHON_ERROR: quen thuộc thành sự kiện JSON;
+    # nhãn ITEM:<n>: của job batch thành trường "item"
+    match = re.match(r"ITEM:(\d+):", message)
+    if match:
+        return dict(parse_event_line(message[match.end():], job_id), item=int(match.group(1)))
+    if message.startswith('EVENT:'):
+        return dict(json.loads(message[len('EVENT:'):]), event='progress', job=job_id)
+    if message.startswith('PROGRESS:'):
+        _, kind, value = message.split(':', 2)
+        return {'event': 'progress', 'job': job_id, 'type': kind, 'value': float(value)}
+    for prefix, kind in (('STATUS:', 'status'), ('RESULT:', 'result'), ('PYTHON_ERROR:', 'error')):
+        if message.startswith(prefix):
+            return {'event': kind, 'job': job_id, 'message': message[len(prefix):].strip()}
+    return {'event': 'log', 'job': job_id, 'message': message}
+
+class RenderServer:
+    # Tiến trình sống lâu: nhận job qua JSON-lines trên stdin, giữ sẵn đường dẫn công cụ, font và cache,
+    # chạy nhiều job song song và trả sự kiện có cấu trúc trên stdout.
+    def __init__(self, base_runtime, max_jobs=2):
+        self.base_runtime = base_runtime
+        self.job_slots = threading.Semaphore(max(1, max_jobs))
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.next_job = 1
+
+    def start_job(self, params, batch=False):
+        with self.jobs_lock:
+            job_id = str(params.get('job') or self.next_job)
+            self.next_job += 1
+            if job_id in self.jobs:
+                raise Exception(f"Job {job_id} đang chạy.")
+            job = {'cancel': threading.Event(), 'processes': set(), 'batch': batch}
+            self.jobs[job_id] = job
+        thread = threading.Thread(target=contextvars.Context().run, args=(self.run_job, job_id, job, params), daemon=True)
+        job['thread'] = thread
+        thread.start()
+        return job_id
+
+    def run_job(self, job_id, job, params):
+        def sink(message, end):
+            # Dòng tiến trình ghi đè (\r) chỉ dành cho terminal, sự kiện progress đã mang thông tin này
+            if message and end != '\r':
+                send_event(parse_event_line(message, job_id))
+
+        _emit_sink.set(sink)
+        _cancel_event.set(job['cancel'])
+        _process_group.set((_active_processes, job['processes']))
+        temp_dir = os.path.join(self.base_runtime['temp_root'], f"job_{sanitize_filename(job_id)}")
+        cache_leases = contextlib.ExitStack()
+        with job_log(self.base_runtime['logs_dir'], job_log_name(f"server_{job_id}")) as log_path:
+            error = None
+            try:
+                with self.job_slots:
+                    check_cancelled()
+                    templates = load_templates(params.get('layouts') or params.get('layout_files') or [])
+                    # Giá trị từ UI có thể là chuỗi (lấy thẳng từ <input>), ép kiểu như argparse ở chế độ dòng lệnh
+                    options = build_options(int(params.get('parts') or 1), float(params.get('part_duration') or 0),
+                                            params.get('encoder') or 'libx264', params.get('seek_mode') or 'input',
+                                            params.get('render_mode') or 'per-part', int(params.get('jobs') or 1),
+                                            float(params.get('quality_headroom') or 1.0), bool(params.get('stream_copy')),
+                                            bool(params.get('streaming')))
+                    runtime = dict(self.job_runtime(), output_dir=params.get('save_path') or self.base_runtime['output_dir'])
+                    os.makedirs(runtime['output_dir'], exist_ok=True)
+                    os.makedirs(temp_dir, exist_ok=True)
+                    if job['batch']:
+                        # Pipeline tải/render của batch, mỗi video có thư mục tạm riêng bên trong thư mục của job
+                        failures = run_batch(params['urls'], params.get('layouts') or params.get('layout_files') or [], options,
+                                             dict(runtime, temp_root=temp_dir), int(params.get('queue_size') or 1))
+                        check_cancelled()
+                        if failures:
+                            raise Exception(f"{len(failures)}/{len(params['urls'])} video lỗi: {', '.join(map(str, failures))}")
+                    else:
+                        source = prepare_source(params['url'], templates, options, runtime, temp_dir, cache_leases)
+                        render_source(source, templates, options, runtime, temp_dir)
+                        emit("STATUS: Hoàn tất tất cả các phần!")
+            except Exception as e:
+                error = "Job đã bị hủy." if job['cancel'].is_set() else str(e)
+                emit(f"PYTHON_ERROR: {error}")
+            finally:
+                cache_leases.close()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                with self.jobs_lock:
+                    self.jobs.pop(job_id, None)
+                send_event({'event': 'done', 'job': job_id, 'ok': error is None, 'cancelled': job['cancel'].is_set(),
+                            'error': error, 'log': log_path})
+
+    def cancel_job(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(str(job_id))
+        if job is None:
+            return False
+        job['cancel'].set()
+        terminate_active_processes(job['processes'])
+        return True
+
+    def job_runtime(self):
+        return dict(self.base_runtime, cookies_path=select_cookies_path(self.base_runtime['cookie_paths']))
+
+    def run_preview(self, request_id, params):
+        # Preview trả kết quả trực tiếp trong response, các dòng trạng thái trung gian được bỏ qua
+        def sink(message, end):
+            pass
+
+        _emit_sink.set(sink)
+        try:
+            preview_path = render_preview(params['url'], params['layout'], float(params.get('time') or 0), self.job_runtime(),
+                                          int(params.get('part') or 1), params.get('format') or 'jpeg')
+            send_event({'id': request_id, 'result': {'path': preview_path, 'data_url': preview_data_url(preview_path)}})
+        except Exception as e:
+            send_event({'id': request_id, 'error': str(e)})
+
+    def handle(self, request):
+        method, params = request.get('method'), request.get('params') or {}
+        if method == 'preview':
+            # Chạy ở luồng riêng để không chặn các request khác (ví dụ cancel); response được gửi khi xong
+            thread = threading.Thread(target=contextvars.Context().run, args=(self.run_preview, request.get('id'), params), daemon=True)
+            thread.start()
+            return None
+        if method == 'render':
+            return {'job': self.start_job(params)}
+        if method == 'batch':
+            return {'job': self.start_job(params, batch=True)}
+        if method == 'cancel':
+            return {'cancelled': self.cancel_job(params.get('job'))}
+        if method == 'ping':
+            with self.jobs_lock:
+                return {'jobs': list(self.jobs)}
+        raise Exception(f"Phương thức không hợp lệ: {method}")
+
+    def serve(self, stream=None):
+        send_event({'event': 'ready'})
+        for line in stream or sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                if request.get('method') == 'shutdown':
+                    break
+                result = self.handle(request)
+                if result is not None:
+                    send_event({'id': request_id, 'result': result})
+            except Exception as e:
+                send_event({'id': request_id, 'error': str(e)})
+        # stdin đóng hoặc nhận shutdown: hủy các job còn lại và chờ chúng dọn dẹp
+        with self.jobs_lock:
+            running = list(self.jobs.items())
+        for job_id, job in running:
+            self.cancel_job(job_id)
+        for _, job in running:
+            job['thread'].join()
+
+def find_cached_source(media_dir, video_id):
+    # Chỉ dùng bản tải đầy đủ trong cache (không phải đoạn cắt) để mốc thời gian khớp với video gốc
+    pattern = re.compile(rf"^{re.escape(sanitize_filename(video_id))}_[0-9a-f]{{12}}\.mp4$")
+    if not media_dir or not os.path.isdir(media_dir):
+        return None
+    return next((os.path.join(media_dir, name) for name in sorted(os.listdir(media_dir)) if pattern.match(name)), None)
+
+def extract_preview_frame(ffmpeg_path, video_info, media_dir, timestamp, dest_path):
+    # Ưu tiên video đã có trong cache; nếu chưa có thì seek thẳng trên link của bản nhỏ nhất đủ PREVIEW_PROXY_HEIGHT
+    source_path = find_cached_source(media_dir, video_info['id'])
+    cmd = [ffmpeg_path, '-y', '-loglevel', 'error']
+    if source_path:
+        cmd += ['-ss', f"{timestamp:.3f}", '-i', source_path]
+    else:
+        formats = [f for f in video_info.get('formats') or []
+                   if f.get('url') and f.get('vcodec') not in (None, 'none') and f.get('height') and f.get('protocol', 'https').startswith('http')]
+        if not formats:
+            raise Exception("Không tìm thấy luồng video để tạo preview.")
+        proxy_format = min(formats, key=lambda f: (f['height'] < PREVIEW_PROXY_HEIGHT, abs(f['height'] - PREVIEW_PROXY_HEIGHT)))
+        headers = "".join(f"{key}: {value}\r\n" for key, value in (proxy_format.get('http_headers') or {}).items())
+        if headers:
+            cmd += ['-headers', headers]
+        cmd += ['-ss', f"{timestamp:.3f}", '-i', proxy_format['url']]
+    partial_path = partial_output_path(dest_path)
+    cmd += ['-frames:v', '1', '-vf', f"scale=-2:{PREVIEW_PROXY_HEIGHT}", '-q:v', '3', partial_path]
+    run_command_with_live_output(cmd)
+    os.replace(partial_path, dest_path)
+
+def prepare_preview_layers(ffmpeg_path, layout, thumbnail_path, video_dir):
+    # Lớp ảnh tĩnh được ghép một lần cho mỗi tổ hợp ảnh/vị trí; chỉnh chữ hay kéo khung video không cần ghép lại.
+    # Từ khung video chỉ zIndex (và thứ tự trong layout) quyết định ảnh nào nằm dưới/trên nó.
+    ordered = sorted((item for item in layout if item['type'] != 'text'), key=lambda x: int(x.get('zIndex', 0)))
+    layer_key = [{'type': 'video', 'zIndex': item.get('zIndex', 0)} if item['type'] == 'video' else item for item in ordered]
+    layers_dir = os.path.join(video_dir, f"layers_{hash_render_inputs(layer_key)[:12]}")
+    background_path = os.path.join(layers_dir, "layer_background.png")
+    if os.path.exists(background_path):
+        os.utime(layers_dir, None)
+    else:
+        work_dir = f"{layers_dir}.partial_{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(work_dir, exist_ok=True)
+        static_paths = {'thumbnail-placeholder': thumbnail_path, **materialize_layout_images(layout, os.path.join(work_dir, "assets"))}
+        precompose_static_layers(ffmpeg_path, layout, static_paths, work_dir)
+        shutil.rmtree(os.path.join(work_dir, "assets"), ignore_errors=True)
+        try:
+            os.replace(work_dir, layers_dir)
+        except OSError:
+            # Một preview khác đã ghép xong cùng lớp
+            shutil.rmtree(work_dir, ignore_errors=True)
+    foreground_path = os.path.join(layers_dir, "layer_foreground.png")
+    return background_path, foreground_path if os.path.exists(foreground_path) else None
+
+def render_preview(url, layout, timestamp, runtime, part_num=1, image_format='jpeg'):
+    # Một khung hình của layout tại `timestamp`, dùng cùng build_ffmpeg_filter với lúc render thật.
+    # Khung hình nguồn và thumbnail được cache theo video nên các lần chỉnh layout sau chỉ còn bước ghép.
+    ffmpeg_path = runtime['ffmpeg_path']
+    video_dir = os.path.join(runtime['preview_dir'], normalize_video_key(url))
+    os.makedirs(video_dir, exist_ok=True)
+    video_info, _ = get_video_metadata(url, runtime, video_dir)
+    duration = video_info.get('duration') or 0
+    timestamp = max(0.0, min(float(timestamp), duration - 0.1) if duration else float(timestamp))
+
+    frame_path = os.path.join(video_dir, f"frame_{int(round(timestamp * 10))}.jpg")
+    if os.path.exists(frame_path):
+        os.utime(frame_path, None)
+    else:
+        extract_preview_frame(ffmpeg_path, video_info, runtime['media_dir'], timestamp, frame_path)
+    thumbnail_path = os.path.join(video_dir, "thumbnail.jpg")
+    if os.path.exists(thumbnail_path):
+        os.utime(thumbnail_path, None)
+    elif video_info.get('thumbnail'):
+        download_thumbnail(video_info['thumbnail'], partial_output_path(thumbnail_path))
+        os.replace(partial_output_path(thumbnail_path), thumbnail_path)
+
+    background_path, foreground_path = prepare_preview_layers(ffmpeg_path, layout, thumbnail_path, video_dir)
+    layer_args, input_map, composited_layout = build_layer_inputs(layout, background_path, foreground_path)
+    text_item = next((item for item in layout if item['type'] == 'text'), None)
+    filter_complex, video_label, _ = build_ffmpeg_filter(composited_layout, input_map, 0, 1, text_item, runtime['font_path'], part_num,
+                                                         canvas_input=1, include_audio=False)
+
+    extension = 'png' if image_format == 'png' else 'jpg'
+    preview_key = hash_render_inputs({'layout': layout, 'timestamp': timestamp, 'part': part_num, 'font': runtime['font_path']})
+    output_path = os.path.join(video_dir, f"preview_{preview_key[:16]}.{extension}")
+    if os.path.exists(output_path):
+        os.utime(output_path, None)
+    else:
+        cmd = [ffmpeg_path, '-y', '-loglevel', 'error', '-i', frame_path] + layer_args
+        cmd += ['-filter_complex', filter_complex, '-map', f'[{video_label}]', '-frames:v', '1']
+        cmd += [] if extension == 'png' else ['-q:v', '3']
+        run_command_with_live_output(cmd + [partial_output_path(output_path)])
+        os.replace(partial_output_path(output_path), output_path)
+        previews = sorted(glob.glob(os.path.join(video_dir, "preview_*")), key=os.path.getmtime, reverse=True)
+        for old_preview in previews[MAX_PREVIEWS_PER_VIDEO:]:
+            try:
+                os.remove(old_preview)
+            except OSError:
+                pass
+        evict_preview_cache(runtime['preview_dir'], MAX_PREVIEW_CACHE_BYTES)
+    return output_path
+
+def evict_preview_cache(preview_dir, max_cache_bytes):
+    # Xóa các mục dùng lâu nhất (theo mtime, được cập nhật mỗi lần dùng lại) cho tới khi dưới max_cache_bytes.
+    # Mỗi thư mục layers_* là một mục vì hai lớp ảnh trong đó phải đi cùng nhau.
+    with file_lock(os.path.join(preview_dir, "cache.lock"), stale_after=60):
+        entries = []
+        for video_name in os.listdir(preview_dir):
+            video_dir = os.path.join(preview_dir, video_name)
+            if not os.path.isdir(video_dir):
+                continue
+            for name in os.listdir(video_dir):
+                if name.endswith(".lock") or ".partial" in name:
+                    continue
+                path = os.path.join(video_dir, name)
+                try:
+                    stat = os.stat(path)
+                    if os.path.isdir(path):
+                        size = sum(os.path.getsize(file_path) for file_path in glob.glob(os.path.join(path, "*")))
+                    else:
+                        size = stat.st_size
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total_bytes <= max_cache_bytes:
+                break
+            if now - mtime < PREVIEW_IN_USE_SECONDS:
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
+        # Thư mục video rỗng được bỏ đi, trừ thư mục vừa được một preview đang chạy tạo ra
+        for video_name in os.listdir(preview_dir):
+            video_dir = os.path.join(preview_dir, video_name)
+            try:
+                if os.path.isdir(video_dir) and not os.listdir(video_dir) and now - os.path.getmtime(video_dir) >= PREVIEW_IN_USE_SECONDS:
+                    os.rmdir(video_dir)
+            except OSError:
+                pass
+
+def preview_data_url(preview_path):
+    mime_type = 'image/png' if preview_path.endswith('.png') else 'image/jpeg'
+    with open(preview_path, 'rb') as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+def read_urls(urls, urls_file):
+    all_urls = list(urls or [])
+    if urls_file:
+        with open(urls_file, 'r', encoding='utf-8') as f:
+            all_urls += [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    return all_urls
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Video Processing Script")
     parser.add_argument('--resources-path', required=True)
     parser.add_argument('--user-data-path', required=True)
-    parser.add_argument('--url', type=str, required=True)
-    parser.add_argument('--layout-file', type=str, required=True)
+    parser.add_argument('--server', action='store_true')
+    parser.add_argument('--server-max-jobs', type=int, default=2)
+    parser.add_argument('--url', type=str, action='append')
+    parser.add_argument('--urls-file', type=str, default="")
+    parser.add_argument('--batch-queue-size', type=int, default=1)
+    parser.add_argument('--layout-file', type=str, action='append')
     parser.add_argument('--parts', type=int, default=1)
     parser.add_argument('--save-path', type=str, default="")
     parser.add_argument('--part-duration', type=int, default=0)
     parser.add_argument('--encoder', type=str, default='libx264')
+    parser.add_argument('--seek-mode', choices=['input', 'filter'], default='input')
+    parser.add_argument('--render-mode', choices=['per-part', 'single-pass'], default='per-part')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--cache-size-gb', type=float, default=20)
+    parser.add_argument('--downloader', choices=['auto', 'native', 'aria2c'], default='auto')
+    parser.add_argument('--aria2c-connections', type=int, default=16)
+    parser.add_argument('--aria2c-split-size', type=str, default='1M')
+    parser.add_argument('--quality-headroom', type=float, default=1.0)
+    parser.add_argument('--stream-copy', action='store_true')
+    parser.add_argument('--metadata-ttl-hours', type=float, default=3)
+    parser.add_argument('--metadata-backend', choices=['auto', 'process'], default='auto')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--preview-time', type=float, default=None)
+    parser.add_argument('--preview-part', type=int, default=1)
+    parser.add_argument('--preview-format', choices=['jpeg', 'png'], default='jpeg')
     
     args = parser.parse_args()
+    if args.server:
+        runtime = build_runtime(args.resources_path, args.user_data_path, args.save_path, args.cache_size_gb,
+                                args.downloader, args.aria2c_connections, args.aria2c_split_size,
+                                args.metadata_ttl_hours, args.metadata_backend)
+        RenderServer(runtime, args.server_max_jobs).serve()
+        sys.exit(0)
+
+    urls = read_urls(args.url, args.urls_file)
+    if not urls:
+        parser.error("Cần ít nhất một --url hoặc --urls-file.")
+    if not args.layout_file:
+        parser.error("Cần ít nhất một --layout-file.")
     
+    if args.preview_time is not None:
+        runtime = build_runtime(args.resources_path, args.user_data_path, args.save_path, args.cache_size_gb,
+                                args.downloader, args.aria2c_connections, args.aria2c_split_size,
+                                args.metadata_ttl_hours, args.metadata_backend)
+        try:
+            preview_path = render_preview(urls[0], load_templates(args.layout_file)[0][1], args.preview_time, runtime,
+                                          args.preview_part, args.preview_format)
+        except Exception as e:
+            emit(f"PYTHON_ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+        emit(f"PREVIEW:{preview_path}")
+        sys.exit(0)
+
+    if len(urls) > 1:
+        runtime = build_runtime(args.resources_path, args.user_data_path, args.save_path, args.cache_size_gb,
+                                args.downloader, args.aria2c_connections, args.aria2c_split_size,
+                                args.metadata_ttl_hours, args.metadata_backend)
+        options = build_options(args.parts, args.part_duration, args.encoder, args.seek_mode, args.render_mode, args.jobs,
+                                args.quality_headroom, args.stream_copy, args.streaming)
+        failures = process_batch(urls, args.layout_file, options, runtime, args.batch_queue_size)
+        sys.exit(1 if failures else 0)
+
     process_video(
-        args.url, 
+        urls[0], 
         args.parts, 
         args.save_path,
         args.part_duration, 
         args.layout_file, 
         args.encoder, 
         args.resources_path,
-        args.user_data_path
+        args.user_data_path,
+        args.seek_mode,
+        args.render_mode,
+        args.jobs,
+        args.cache_size_gb,
+        args.downloader,
+        args.aria2c_connections,
+        args.aria2c_split_size,
+        args.quality_headroom,
+        args.stream_copy,
+        args.metadata_ttl_hours,
+        args.metadata_backend,
+        args.streaming
     )